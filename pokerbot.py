@@ -1,7 +1,42 @@
-import telebot #pyTelegramBotAPI
+from __future__ import annotations #Annotations mentioning telebot types aren't evaluated, see _importTelebot()
 import random
-import datetime #Get timestamps for logs
-#import threading #No need to use our own threads, telebot is synchronous, and uses threading (takes care of it for us) 
+import itertools
+import math
+import sys
+import os
+import json
+import collections
+import time
+import hashlib #Derive per-worker simulation seeds
+import bisect
+import threading
+import multiprocessing
+import concurrent.futures
+import logging
+import queue
+import secrets
+import urllib.parse
+try:
+    import numpy #Optional, used by the batched simulation engine
+except ImportError:
+    numpy = None
+telebot = None #pyTelegramBotAPI, only imported once the Telegram bot layer is used (see _importTelebot())
+#NOTE: telebot handlers only hand updates over to our own handler threads (see CallbackDispatcher), simulations run on compute threads/processes
+
+SUITES = ["C", "H", "S", "D"] #Suite order of the card encoding: index = 13*suiteIndex + value-2
+FULL_DECK_MASK = (1 << 52) - 1 #52-bit mask with every card of the deck
+SUITE_MASKS = {suite: 0x1FFF << (13*i) for i, suite in enumerate(SUITES)} #Masks containing every card of a given suite
+
+logger = logging.getLogger("pokerbot")
+
+def _importTelebot():
+    """Imports pyTelegramBotAPI (once) and returns it. The calculator doesn't need it, so scripts, tests and simulation worker
+    processes only using the calculator don't pay for importing telebot and requests."""
+    global telebot
+    if telebot is None:
+        import telebot as telebotModule
+        telebot = telebotModule
+    return telebot
 
 class PokerBotException(Exception):
     """Default class for pokerbot exceptions, does nothing."""
@@ -9,66 +44,822 @@ class PokerBotException(Exception):
 
 class PokerBot():
     """Represents a Telegram poker bot."""
-    def __init__(self, token: str, channelId=None)->None:
+    def __init__(self, token: str, channelId=None, preflopTablePath=None, equityCacheSize=10000, computeWorkers=2, sessionTtl=3600, maxSessions=10000, notifyExpiredSessions=True, handlerWorkers=4, maxPendingUpdates=1000, adminIds=(), metricsPath=None, metricsInterval=15, sessionStorePath=None, spillAfter=300)->None:
         """Initializes poker bot with the given token. Sends error/maintenance messages to channelId.
+        Winning chances are calculated on computeWorkers threads and cached (see EquityExecutor and EquityCache), preflop ones are loaded from preflopTablePath if given.
+        Sessions expire after sessionTtl seconds without activity, and at most maxSessions are kept in memory (see SessionRegistry).
+        If sessionStorePath is given, sessions idle for spillAfter seconds (or beyond maxSessions) are moved to a SessionStore file there, and loaded back
+        on their next callback. Sessions still in memory are moved there when the bot stops, so games go on after a restart.
+        Updates are handled on handlerWorkers threads: each session's updates one at a time in the order they were received, different sessions in parallel (see CallbackDispatcher).
+        In webhook mode, updates are refused (and retried later by Telegram) while maxPendingUpdates are waiting to be handled.
+        Users in adminIds can use the /stats command (see Metrics). If metricsPath is given, metrics are written there in Prometheus format every metricsInterval seconds.
         Note: the bot has to be an admin member of the logging group given"""
         self.token = token
         self.channelId = channelId
-        self.sessions = []
-        self.bot = telebot.TeleBot(token)
-        self.requestId = 0
+        self.logHandler = None
+        self.webhookServer = None #Set by start() in webhook mode
+        if logger.level == logging.NOTSET: #Bot messages are logged at INFO level, which the root logger drops by default
+            logger.setLevel(logging.INFO)
+        if not logger.handlers and not logging.getLogger().handlers: #Logging isn't configured (bot used as a library): print messages like __main__ does
+            consoleHandler = logging.StreamHandler()
+            consoleHandler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+            logger.addHandler(consoleHandler)
+        self.adminIds = set(adminIds)
+        self.metricsPath = metricsPath
+        self.metricsInterval = metricsInterval
+        self.notifyExpiredSessions = notifyExpiredSessions
+        store = SessionStore(sessionStorePath) if sessionStorePath is not None else None
+        self.sessions = SessionRegistry(sessionTtl, maxSessions, self.expireSession, store, lambda record: Session.fromRecord(record, self), spillAfter)
+        self.bot = _importTelebot().TeleBot(token, threaded=False) #Handlers run in order on the polling thread, they only hand work over to the dispatcher
+        if channelId is not None:
+            self.logHandler = TelegramLogHandler(self.bot, channelId)
+            logger.addHandler(self.logHandler)
+        for name in ("reply_to", "send_message", "edit_message_text", "delete_message", "set_webhook", "remove_webhook"): #Telegram API calls made by the bot
+            setattr(self.bot, name, metrics.timed("pokerbot_telegram_api_seconds", name, getattr(self.bot, name)))
+        metrics.setGauge("pokerbot_active_sessions", lambda: len(self.sessions))
+        metrics.setGauge("pokerbot_stored_sessions", self.sessions.getStoredCount)
+        self.dispatcher = CallbackDispatcher(handlerWorkers, lambda e: self.logMessage("Got exception while handling update: "+repr(e), level=logging.ERROR), maxPendingUpdates)
+        self.sessionIds = itertools.count(1 if store is None else store.getMaxId()+1) #Stored sessions keep their IDs
+        self.sessionIdLock = threading.Lock()
+        self.equityCache = EquityCache(equityCacheSize)
+        if preflopTablePath is not None:
+            self.equityCache.loadPreflopTable(preflopTablePath)
+        self.equityExecutor = EquityExecutor(self.equityCache, computeWorkers, lambda e: self.logMessage("Got exception while calculating winning chance: "+repr(e), level=logging.ERROR))
 
         @self.bot.message_handler(commands=["help"])
         def helpMessageHandler(message)->None:
-            self.bot.reply_to(message, "Hi! I'm a bot designed to help you get better at poker by informing you of your winning chances given the game state you gice me. Try me out using /start !")
+            self.dispatcher.dispatch(("chat", message.chat.id), self.bot.reply_to, message, "Hi! I'm a bot designed to help you get better at poker by informing you of your winning chances given the game state you gice me. Try me out using /start !")
+
+        @self.bot.message_handler(commands=["stats"])
+        def statsMessageHandler(message)->None:
+            """Admin-only /stats command: shows the metrics summary. "/stats off", "/stats on" and "/stats reset" turn metrics off, on, or reset them."""
+            self.dispatcher.dispatch(("chat", message.chat.id), self.statsCommand, message)
 
         @self.bot.message_handler(commands=["start"])
         def startSession(message)->None:
-            """Default /start command message handler. Creates new Session() object and calls its start() method."""
-            try:
-                self.requestId += 1
-                session = Session(self.requestId, message, self)
-                self.sessions.append(session)
-                session.start()
-            except Exception as e:
-                self.logMessage("Got exception while running /start command: "+repr(e))
+            """Default /start command message handler. Creates new Session() object and dispatches its start() method."""
+            session = Session(self.nextSessionId(), message, self)
+            self.sessions.add(session)
+            def start()->None:
+                try:
+                    self.sessions.evictExtraSessions() #Not on the intake thread: may call Telegram or write to the session store
+                    session.start()
+                except Exception as e:
+                    self.logMessage("Got exception while running /start command: "+repr(e), level=logging.ERROR)
+            self.dispatcher.dispatch(session.idStr, start)
         
 
         @self.bot.callback_query_handler(func=lambda call: True)
         def botCallbackHandler(call)->None:
-            """Default bot callback handler. Gives call and call content (without session ID) to matching session's callbackHandler.
+            """Default bot callback handler. Dispatches call and call content (without session ID) to matching session's callbackHandler.
             If no session matches, raises a PokerBotException and sends a message to callback sender."""
             try:
                 sessionId, data = call.data.split("-", 1)
-                session = None
-                for s in self.sessions:
-                    if s.idStr == sessionId:
-                        session = s
-                        break
-                if session is None:
-                    self.bot.send_message(call.from_user.id, "Error: given ID doesn't match any known sessions")
-                    raise PokerBotException("Given ID doesn't match any known sessions")
-                session.callbackHandler(call, data)
-            except Exception as e:
-                self.logMessage("Got exception while handling callback: "+repr(e))
+            except Exception as e: #Malformed callback data: log it rather than failing the update batch (or the webhook request)
+                self.logMessage("Got exception while handling callback: "+repr(e), level=logging.ERROR)
+                return
+            def handle()->None:
+                try:
+                    session = self.sessions.get(sessionId)
+                    if session is None:
+                        self.bot.send_message(call.from_user.id, "Error: given ID doesn't match any known sessions")
+                        raise PokerBotException("Given ID doesn't match any known sessions")
+                    session.callbackHandler(call, data)
+                except Exception as e:
+                    self.logMessage("Got exception while handling callback: "+repr(e), level=logging.ERROR)
+            self.dispatcher.dispatch(sessionId, handle)
+    
+    def statsCommand(self, message)->None:
+        """Handles the /stats command (see statsMessageHandler)."""
+        if message.from_user.id not in self.adminIds:
+            self.bot.reply_to(message, "Error: you're not allowed to see the bot's stats!")
+            return
+        argument = message.text.split()[1] if len(message.text.split()) > 1 else ""
+        if argument in ("on", "off"):
+            metrics.enabled = argument == "on"
+        elif argument == "reset":
+            metrics.reset()
+        self.bot.reply_to(message, metrics.formatSummary())
+    
+    def nextSessionId(self)->int:
+        """Returns a new unique session ID (thread-safe)."""
+        with self.sessionIdLock:
+            return next(self.sessionIds)
 
-    def start(self)->None:
-        """Sends a startup message to logging group (if given), then starts the Telegram bot using telebot.TeleBot.infinity_polling()"""
+    def start(self, webhookUrl:str=None, host:str="0.0.0.0", port:int=8443, secretToken:str=None)->None:
+        """Sends a startup message to logging group (if given), then starts the Telegram bot using telebot.TeleBot.infinity_polling(),
+        or in webhook mode if webhookUrl is given: Telegram then posts updates to webhookUrl, which must lead to a WebhookServer listening on host:port.
+        secretToken (random if not given) authenticates Telegram's requests, instances behind a load balancer have to share it."""
         print(" ---- Starting bot ---- ")
-        self.logMessage("Pokerbot has started!")
-        self.bot.infinity_polling()
-    
-    def logMessage(self, text:str, sendToChat:bool=True)->None:
-        """Logs entry containing text into logs to get better idea of how it works. sendToChat defines if message should be sent to chat or not."""
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        messageText = "[{}] {}".format(timestamp, text)
-        if self.channelId is not None and sendToChat:
-            self.bot.send_message(self.channelId, messageText)
-        print(messageText)
-        #TODO: Maybe import a logging library and call it too?
+        if numpy is not None: _getBatchTables() #Build lookup tables now rather than during the first user request
+        threading.Thread(target=self.expireSessionsLoop, name="session-expiry", daemon=True).start()
+        if self.metricsPath is not None: threading.Thread(target=self.writeMetricsLoop, name="metrics-writer", daemon=True).start()
+        try:
+            if webhookUrl is None:
+                self.logMessage("Pokerbot has started!")
+                self.bot.infinity_polling()
+                return
+            if secretToken is None: secretToken = secrets.token_urlsafe(32)
+            server = self.webhookServer = WebhookServer(self, host, port, secretToken, urllib.parse.urlsplit(webhookUrl).path or "/") #Reverse proxies may forward a non-root URL as is
+            self.bot.remove_webhook()
+            self.bot.set_webhook(url=webhookUrl, secret_token=secretToken)
+            self.logMessage("Pokerbot has started! (webhook mode)")
+            server.run()
+        finally:
+            self.sessions.spillAll() #Keep open sessions for the next start, if there's a session store
+    
+    def logMessage(self, text:str, sendToChat:bool=True, level:int=logging.INFO)->None:
+        """Logs entry containing text into logs to get better idea of how it works. sendToChat defines if message should be sent to chat or not.
+        Never blocks: messages are sent to the logging chat in batches by a background thread (see TelegramLogHandler)."""
+        logger.log(level, text, extra={"sendToChat": sendToChat})
+    
+    def expireSession(self, session)->None:
+        """SessionRegistry callback for sessions removed because they were idle for too long (or too many sessions were open).
+        Dispatched after the session's pending updates, so its Telegram call never holds up the caller."""
+        def expire()->None:
+            try:
+                session.expire(self.notifyExpiredSessions)
+            except Exception as e:
+                self.logMessage("Got exception while expiring session: "+repr(e), sendToChat=False, level=logging.ERROR)
+        self.dispatcher.dispatch(session.idStr, expire)
+    
+    def writeMetricsLoop(self)->None:
+        """Writes the metrics to metricsPath in Prometheus format every metricsInterval seconds. Runs on its own thread."""
+        while True:
+            try:
+                metrics.writePrometheusFile(self.metricsPath)
+            except Exception as e:
+                self.logMessage("Got exception while writing metrics: "+repr(e), sendToChat=False, level=logging.ERROR)
+            time.sleep(self.metricsInterval)
+    
+    def expireSessionsLoop(self)->None:
+        """Expires idle sessions regularly, logging the number of sessions left and their approximate memory use. Runs on its own thread."""
+        while True:
+            time.sleep(max(1, min(60, self.sessions.ttl/10)))
+            expired = self.sessions.expireSessions()
+            if expired:
+                self.logMessage("Expired {} idle session(s), {} active session(s) using ~{} KB, {} stored session(s)".format(len(expired), len(self.sessions), self.sessions.getMemoryUsage()//1024, self.sessions.getStoredCount()), sendToChat=False)
+
+class TelegramLogHandler(logging.Handler):
+    """Logging handler posting log messages to a Telegram chat from a background thread, so logging never waits for Telegram.
+    Messages logged within batchDelay seconds are posted together, identical ones only once with their count, and posts are at least
+    minInterval seconds apart (messages logged meanwhile wait for the next post). Messages are dropped once maxQueued are waiting.
+    Records logged with extra={"sendToChat": False} aren't posted."""
+    maxPostLength = 4096 #Telegram message length limit
+    
+    def __init__(self, bot, chatId, minInterval:float=3, batchDelay:float=0.5, maxQueued:int=1000, level:int=logging.NOTSET):
+        """Initializes handler posting to chatId through bot (a telebot.TeleBot) and starts its sender thread."""
+        super().__init__(level)
+        self.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+        self.bot = bot
+        self.chatId = chatId
+        self.minInterval = minInterval
+        self.batchDelay = batchDelay
+        self.queue = queue.Queue(maxQueued) #(message, time logged), None asks the sender thread to stop
+        self.droppedCount = 0 #Messages dropped because the queue was full, since the last post
+        self.postCount = 0
+        self.lastPost = -math.inf
+        self.thread = threading.Thread(target=self.sendLoop, name="log-sender", daemon=True)
+        self.thread.start()
+    
+    def filter(self, record: logging.LogRecord)->bool:
+        """Skips records logged with extra={"sendToChat": False}."""
+        return getattr(record, "sendToChat", True) and super().filter(record)
+    
+    def emit(self, record: logging.LogRecord)->None:
+        """Queues record to be posted by the sender thread, or drops it if the queue is full."""
+        try:
+            self.queue.put_nowait((self.format(record), record.created))
+        except queue.Full:
+            self.droppedCount += 1
+        except Exception:
+            self.handleError(record)
+    
+    def sendLoop(self)->None:
+        """Sender thread: waits for a message, collects the ones following it until the batch is due, then posts them."""
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None: break
+            batch = {} #Message -> [count, time first logged, time last logged], in order of first appearance
+            deadline = max(time.monotonic()+self.batchDelay, self.lastPost+self.minInterval)
+            while item is not None:
+                message, created = item
+                if message in batch:
+                    batch[message][0] += 1
+                    batch[message][2] = created
+                else:
+                    batch[message] = [1, created, created]
+                try:
+                    item = self.queue.get(timeout=max(0, deadline-time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None: running = False
+            self.post(batch)
+    
+    def post(self, batch:dict)->None:
+        """Posts a batch of messages as a single Telegram message. Failures are printed, not logged (that could loop forever)."""
+        lines = []
+        for message, (count, firstLogged, lastLogged) in batch.items():
+            lines.append(message if count == 1 else "{} (×{} in the last {:.0f} s)".format(message, count, lastLogged-firstLogged))
+        droppedCount, self.droppedCount = self.droppedCount, 0
+        if droppedCount: lines.append("({} more message(s) dropped)".format(droppedCount))
+        text = "\n".join(lines)
+        if len(text) > self.maxPostLength: text = text[:self.maxPostLength-1]+"…"
+        self.lastPost = time.monotonic()
+        try:
+            self.bot.send_message(self.chatId, text)
+            self.postCount += 1
+        except Exception as e:
+            print("Couldn't send logs to chat: "+repr(e), file=sys.stderr)
+    
+    def close(self)->None:
+        """Posts the messages still waiting, then stops the sender thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(10)
+        super().close()
+
+class Histogram():
+    """Prometheus-style histogram: counts of observed values per bucket (bucket i holds values <= bounds[i], the last one the others), their sum and count."""
+    def __init__(self, bounds:tuple):
+        """Initializes an empty histogram with increasing bucket bounds."""
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds)+1)
+        self.sum = 0
+        self.count = 0
+    
+    def observe(self, value:float)->None:
+        """Counts value in its bucket."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q:float)->float:
+        """Returns an upper bound of the q quantile (0 < q <= 1): the bound of the bucket holding it (math.inf past the last bound)."""
+        rank = q*self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank: return bound
+        return math.inf
+
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) #Seconds
+RATE_BUCKETS = (1e3, 3e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7) #Iterations per second
+
+def _escapeLabelValue(label)->str:
+    """Escapes a Prometheus label value (backslashes, double quotes and line feeds)."""
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics():
+    """Counters, histograms and gauges of the bot's hot paths, shared by the whole process (see the metrics global).
+    Recording is cheap (a lock and a few additions) and does nothing while enabled is False, which can be changed at any time.
+    Metrics are defined by METRIC_DEFINITIONS: name -> (type, label name or None, help text, histogram buckets)."""
+    def __init__(self, enabled:bool=True):
+        """Initializes empty metrics."""
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.values = {} #(name, label) -> Histogram or counter value
+        self.gauges = {} #name -> function returning the gauge's current value
+    
+    def observe(self, name:str, value:float, label:str=None)->None:
+        """Adds value to histogram name (for the given label value)."""
+        if not self.enabled: return
+        with self.lock:
+            histogram = self.values.get((name, label))
+            if histogram is None:
+                histogram = self.values[(name, label)] = Histogram(METRIC_DEFINITIONS[name][3])
+            histogram.observe(value)
+    
+    def increment(self, name:str, amount:int=1, label:str=None)->None:
+        """Adds amount to counter name (for the given label value)."""
+        if not self.enabled: return
+        with self.lock:
+            self.values[(name, label)] = self.values.get((name, label), 0)+amount
+    
+    def setGauge(self, name:str, func)->None:
+        """Sets the function returning the current value of gauge name."""
+        self.gauges[name] = func
+    
+    def timed(self, name:str, label:str, func):
+        """Returns a wrapper of func recording the duration of each of its calls in histogram name."""
+        def wrapper(*args, **kwargs):
+            if not self.enabled: return func(*args, **kwargs)
+            startTime = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter()-startTime, label)
+        return wrapper
+    
+    def reset(self)->None:
+        """Forgets all recorded values (gauges are kept)."""
+        with self.lock:
+            self.values.clear()
+    
+    def getSnapshot(self)->dict:
+        """Returns {(name, label): histogram or counter value} (histograms are copies) plus {(gauge name, None): value}."""
+        with self.lock:
+            snapshot = {}
+            for key, value in self.values.items():
+                if isinstance(value, Histogram):
+                    copy = Histogram(value.bounds)
+                    copy.counts, copy.sum, copy.count = value.counts[:], value.sum, value.count
+                    value = copy
+                snapshot[key] = value
+        for name, func in self.gauges.items():
+            snapshot[(name, None)] = func()
+        return snapshot
+    
+    def formatPrometheus(self)->str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        snapshot = self.getSnapshot()
+        lines = []
+        for name, (metricType, labelName, helpText, bounds) in METRIC_DEFINITIONS.items():
+            lines.append("# HELP {} {}".format(name, helpText))
+            lines.append("# TYPE {} {}".format(name, metricType))
+            for (keyName, label), value in sorted(snapshot.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+                if keyName != name: continue
+                labels = "" if label is None else '{}="{}"'.format(labelName, _escapeLabelValue(label))
+                if metricType != "histogram":
+                    lines.append("{}{} {}".format(name, "{"+labels+"}" if labels else "", value))
+                    continue
+                seen = 0
+                for bound, count in zip(value.bounds+(math.inf,), value.counts):
+                    seen += count
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels+"," if labels else "", "+Inf" if bound == math.inf else bound, seen))
+                lines.append("{}_sum{} {}".format(name, "{"+labels+"}" if labels else "", value.sum))
+                lines.append("{}_count{} {}".format(name, "{"+labels+"}" if labels else "", value.count))
+        return "\n".join(lines)+"\n"
+    
+    def writePrometheusFile(self, path:str)->None:
+        """Writes formatPrometheus() to path, atomically (readers never see a partly written file)."""
+        temporaryPath = path+".tmp"
+        with open(temporaryPath, "w") as file:
+            file.write(self.formatPrometheus())
+        os.replace(temporaryPath, path)
+    
+    def formatSummary(self)->str:
+        """Returns a human-readable summary of the metrics, shown by the /stats command."""
+        snapshot = self.getSnapshot()
+        lines = ["Metrics are {}".format("on" if self.enabled else "off (use /stats on)")]
+        lines.append("Active sessions: {}".format(snapshot.get(("pokerbot_active_sessions", None), 0)))
+        def describe(title:str, histogram:Histogram, unit:float=1000, unitName:str="ms")->str:
+            return "{}: {} calls, mean {:.1f} {}, p50 ≤ {:g} {}, p95 ≤ {:g} {}".format(title, histogram.count, histogram.sum/histogram.count*unit, unitName,
+                histogram.quantile(0.5)*unit, unitName, histogram.quantile(0.95)*unit, unitName)
+        for title, name in (("Callbacks", "pokerbot_callback_seconds"), ("Telegram API", "pokerbot_telegram_api_seconds")):
+            entries = sorted((label, value) for (keyName, label), value in snapshot.items() if keyName == name)
+            if entries: lines.append(title+":")
+            for label, histogram in entries:
+                lines.append("  "+describe(label, histogram))
+        equity = snapshot.get(("pokerbot_equity_seconds", None))
+        if equity is not None:
+            lines.append(describe("Winning chances", equity))
+            lines.append("  {:.0f} iterations/s on average".format(snapshot.get(("pokerbot_equity_iterations_total", None), 0)/equity.sum if equity.sum else 0))
+        lines.append("getScore calls: {}, hands scored by simulations: {}".format(snapshot.get(("pokerbot_get_score_calls_total", None), 0), snapshot.get(("pokerbot_hand_evaluations_total", None), 0)))
+        return "\n".join(lines)
+
+METRIC_DEFINITIONS = {
+    "pokerbot_callback_seconds": ("histogram", "action", "Time spent handling session callbacks, by callback action.", DURATION_BUCKETS),
+    "pokerbot_equity_seconds": ("histogram", None, "Time spent calculating winning chances (PokerCalculator.getEquity).", DURATION_BUCKETS),
+    "pokerbot_equity_iterations_per_second": ("histogram", None, "Simulation speed of winning chance calculations.", RATE_BUCKETS),
+    "pokerbot_equity_iterations_total": ("counter", None, "Iterations (or enumerated outcomes) of winning chance calculations.", None),
+    "pokerbot_get_score_calls_total": ("counter", None, "Calls to PokerCalculator.getScore.", None),
+    "pokerbot_hand_evaluations_total": ("counter", None, "Hands scored by winning chance calculations (one per player and outcome).", None),
+    "pokerbot_telegram_api_seconds": ("histogram", "method", "Latency of Telegram API calls, by method.", DURATION_BUCKETS),
+    "pokerbot_active_sessions": ("gauge", None, "Sessions currently open (in memory).", None),
+    "pokerbot_stored_sessions": ("gauge", None, "Idle sessions spilled to the session store.", None),
+}
+
+metrics = Metrics()
+
+class CallbackDispatcher():
+    """Runs tasks on a thread pool: tasks with the same key (e.g. a session ID) run one at a time in the order they were dispatched,
+    tasks with different keys run in parallel."""
+    def __init__(self, workers:int=4, errorHandler=None, maxPending:int=None):
+        """Initializes dispatcher with its number of threads. errorHandler(exception) is called for tasks raising exceptions.
+        The dispatcher is full (see isFull()) once maxPending tasks are waiting or running, callers should then stop dispatching new tasks for a while."""
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="dispatch")
+        self.queues = {} #Key -> deque of (func, args) waiting to run, the key is present while one of its tasks is running
+        self.lock = threading.Lock()
+        self.pendingCount = 0 #Tasks dispatched but not finished yet
+        self.maxPending = maxPending
+        self.errorHandler = errorHandler
+    
+    def isFull(self)->bool:
+        """Returns True if maxPending tasks are waiting or running."""
+        return self.maxPending is not None and self.pendingCount >= self.maxPending
+    
+    def dispatch(self, key, func, *args)->None:
+        """Runs func(*args) after all tasks previously dispatched with the same key."""
+        with self.lock:
+            self.pendingCount += 1
+            tasks = self.queues.get(key)
+            if tasks is not None:
+                tasks.append((func, args)) #A thread is already running this key's tasks, it'll run this one too
+                return
+            self.queues[key] = collections.deque([(func, args)])
+        self.pool.submit(self._runQueue, key)
+    
+    def _runQueue(self, key)->None:
+        """Thread pool task: runs key's tasks until its queue is empty."""
+        while True:
+            with self.lock:
+                tasks = self.queues[key]
+                if not tasks:
+                    del self.queues[key]
+                    return
+                func, args = tasks.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                if self.errorHandler is not None: self.errorHandler(e)
+            finally:
+                with self.lock:
+                    self.pendingCount -= 1
+    
+    def shutdown(self)->None:
+        """Waits for dispatched tasks to finish and stops the threads."""
+        self.pool.shutdown()
+
+class WebhookServer():
+    """Minimal asyncio HTTP server receiving the updates Telegram posts to the bot's webhook. Each update is handed over to the bot's
+    telebot handlers (which only dispatch it, see CallbackDispatcher), so the server answers right away. While the dispatcher is full,
+    updates are refused with a 503 status: Telegram keeps them and sends them again later."""
+    maxBodySize = 1 << 20 #Updates are a few KB at most
+    retryAfter = 1 #Seconds Telegram is asked to wait before retrying refused updates
+    
+    def __init__(self, parent: PokerBot, host:str="0.0.0.0", port:int=8443, secretToken:str=None, path:str="/"):
+        """Initializes server for parent's updates posted to path. Requests must carry secretToken in their X-Telegram-Bot-Api-Secret-Token header (if given)."""
+        self.parent = parent
+        self.host = host
+        self.port = port #Actual port once the server is listening (useful with port 0)
+        self.secretToken = secretToken
+        self.path = path
+        self.ready = threading.Event() #Set once the server is listening
+        self.loop = None
+        self.stopEvent = None
+    
+    def run(self)->None:
+        """Runs the server until stop() is called."""
+        import asyncio #Only needed in webhook mode
+        asyncio.run(self.serve())
+    
+    def stop(self)->None:
+        """Stops the server (thread-safe)."""
+        if self.loop is not None: self.loop.call_soon_threadsafe(self.stopEvent.set)
+    
+    async def serve(self)->None:
+        """Listens to host:port until stop() is called."""
+        import asyncio
+        self.loop = asyncio.get_running_loop()
+        self.stopEvent = asyncio.Event()
+        server = await asyncio.start_server(self.handleConnection, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await self.stopEvent.wait()
+    
+    async def handleConnection(self, reader, writer)->None:
+        """Answers the HTTP/1.1 requests of a connection (kept alive, Telegram reuses its connections), read from reader and written to writer (asyncio streams)."""
+        import asyncio, http
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine: break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""): break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > self.maxBodySize:
+                    status = 413
+                    keepAlive = False
+                else:
+                    body = await reader.readexactly(length)
+                    method, path = requestLine.decode("latin-1").split()[:2]
+                    status = self.handleRequest(method, path, headers, body)
+                    keepAlive = headers.get("connection", "").lower() != "close"
+                extraHeaders = "Retry-After: {}\r\n".format(self.retryAfter) if status == 503 else ""
+                writer.write("HTTP/1.1 {} {}\r\nContent-Length: 0\r\n{}{}\r\n".format(status, http.HTTPStatus(status).phrase, extraHeaders, "" if keepAlive else "Connection: close\r\n").encode("latin-1"))
+                await writer.drain()
+                if not keepAlive: break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass #Broken or malformed request, drop the connection
+        finally:
+            writer.close()
+    
+    def handleRequest(self, method:str, path:str, headers:dict, body:bytes)->int:
+        """Handles a request of the webhook, returns the HTTP status of the answer."""
+        if urllib.parse.urlsplit(path).path != self.path: return 404 #Telegram posts to the full webhook URL, query string included
+        if method != "POST": return 405
+        if self.secretToken is not None and not secrets.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1"), self.secretToken.encode("utf-8")): return 403 #Bytes, headers may have non-ASCII characters
+        if self.parent.dispatcher.isFull(): return 503
+        try:
+            update = telebot.types.Update.de_json(body.decode("utf-8"))
+        except Exception:
+            return 400
+        self.parent.bot.process_new_updates([update])
+        return 200
+
+class SessionRegistry():
+    """Sessions of a PokerBot by ID, ordered by last activity. Sessions idle for more than ttl seconds are removed by expireSessions(),
+    and evictExtraSessions() removes the least recently active ones beyond maxSessions. onExpire(session) is called for removed sessions.
+    With a store (see SessionStore), sessions idle for more than spillAfter seconds, or beyond maxSessions, are saved to the store and dropped
+    from memory instead, then rebuilt with restore(record) by the next get() asking for them. Stored sessions are only expired after ttl seconds."""
+    def __init__(self, ttl:float=3600, maxSessions:int=10000, onExpire=None, store=None, restore=None, spillAfter:float=300):
+        """Initializes an empty registry (stored sessions are only loaded once asked for)."""
+        self.ttl = ttl
+        self.maxSessions = maxSessions
+        self.onExpire = onExpire
+        self.store = store
+        self.restore = restore
+        self.spillAfter = spillAfter
+        self.sessions = collections.OrderedDict() #idStr -> Session, least recently active first
+        self.lock = threading.Lock()
+    
+    def add(self, session)->None:
+        """Adds a new session. Only updates memory, so it's safe on the update intake thread: extra sessions are removed by evictExtraSessions()."""
+        session.lastActivity = time.monotonic()
+        with self.lock:
+            self.sessions[session.idStr] = session
+    
+    def evictExtraSessions(self)->list:
+        """Removes (or spills to the store) the least recently active sessions beyond maxSessions, returns the removed ones (not the spilled ones)."""
+        with self.lock:
+            evicted = self._evict()
+        self._expire(evicted)
+        return evicted
+    
+    def get(self, idStr:str):
+        """Returns the session with the given ID (None if there isn't any) and marks it as active. Sessions spilled to the store are loaded back."""
+        with self.lock:
+            session = self.sessions.get(idStr)
+            if session is None and self.store is not None and idStr.isdigit():
+                stored = self.store.pop(int(idStr))
+                if stored is not None:
+                    session = self.restore(stored[1])
+                    self.sessions[idStr] = session
+                    self._evict()
+            if session is not None:
+                session.lastActivity = time.monotonic()
+                self.sessions.move_to_end(idStr)
+            return session
+    
+    def remove(self, session)->None:
+        """Removes a session (without calling onExpire), does nothing if it was already removed."""
+        with self.lock:
+            if self.sessions.get(session.idStr) is session: del self.sessions[session.idStr]
+    
+    def expireSessions(self, now=None)->list:
+        """Removes and returns the sessions idle for more than ttl seconds (now defaults to time.monotonic()), including stored ones.
+        With a store, sessions idle for more than spillAfter seconds are spilled to it."""
+        if now is None: now = time.monotonic()
+        expired = []
+        spilled = []
+        with self.lock:
+            while self.sessions:
+                session = next(iter(self.sessions.values()))
+                idleTime = now-session.lastActivity
+                if idleTime > self.ttl:
+                    expired.append(self.sessions.popitem(last=False)[1])
+                elif self.store is not None and idleTime > self.spillAfter:
+                    spilled.append(self.sessions.popitem(last=False)[1])
+                else:
+                    break
+            if self.store is not None:
+                self._spill(spilled)
+                expired += [self.restore(record) for _, record in self.store.popExpired(time.time()-(time.monotonic()-now)-self.ttl)]
+        self._expire(expired)
+        return expired
+    
+    def spillAll(self)->None:
+        """Spills every session to the store (e.g. before the bot stops, so they survive restarts). Does nothing without a store."""
+        if self.store is None: return
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            self._spill(sessions)
+    
+    def _evict(self)->list:
+        """Removes the least recently active sessions beyond maxSessions (lock held): spills them if there's a store, otherwise returns them to be expired."""
+        evicted = []
+        while len(self.sessions) > self.maxSessions:
+            evicted.append(self.sessions.popitem(last=False)[1])
+        if self.store is None: return evicted
+        self._spill(evicted)
+        return []
+    
+    def _spill(self, sessions:list)->None:
+        """Saves removed sessions to the store (lock held), with their last activity as a wall clock time.
+        Sessions busy handling a callback are put back in memory instead, their state may be changing."""
+        records = []
+        now = time.monotonic()
+        wallNow = time.time()
+        for session in sessions:
+            if not session.lock.acquire(blocking=False):
+                self.sessions[session.idStr] = session
+                continue
+            try:
+                session.cancelEquityJob()
+                records.append((wallNow-(now-session.lastActivity), session.toRecord()))
+            finally:
+                session.lock.release()
+        if records: self.store.save(records)
+    
+    def _expire(self, sessions:list)->None:
+        """Calls onExpire for removed sessions (without holding the lock, since it usually calls Telegram)."""
+        if self.onExpire is not None:
+            for session in sessions: self.onExpire(session)
+    
+    def getMemoryUsage(self, sampleSize:int=100)->int:
+        """Returns the approximate memory used by sessions in bytes, extrapolated from the sampleSize most recently active ones.
+        Objects shared between sessions (parent bot, interned cards) aren't counted."""
+        with self.lock:
+            sample = list(itertools.islice(reversed(self.sessions.values()), sampleSize))
+            count = len(self.sessions)
+        if not sample: return 0
+        parent = sample[0].parent
+        shared = {id(card) for card in Card._byIndex} | {id(parent)} | {id(value) for value in vars(parent).values()} #Cache, executor, bot...
+        sampleSize = sum(_getObjectSize(session, set(shared)) for session in sample)
+        return sampleSize*count//len(sample)
+    
+    def __len__(self)->int:
+        """Number of active sessions (in memory)."""
+        return len(self.sessions)
+    
+    def getStoredCount(self)->int:
+        """Number of sessions spilled to the store."""
+        if self.store is None: return 0
+        with self.lock:
+            return len(self.store)
+    
+    def __contains__(self, session)->bool:
+        """Checks if session is registered (in memory)."""
+        return self.sessions.get(session.idStr) is session
+
+class SessionStore():
+    """SQLite file keeping sessions spilled by a SessionRegistry, one row of integers and short strings per session (see Session.toRecord()),
+    with the session's last activity as a wall clock time. Not thread-safe by itself: the registry only uses it while holding its lock."""
+    columns = ("id", "userId", "chatId", "firstMessageId", "botMessageId", "playerCount", "playerDeck", "tableCards", "deckMask", "actionStack", "dataStack")
+    
+    def __init__(self, path:str):
+        """Opens (or creates) the store at path. Sessions aren't loaded until asked for."""
+        import sqlite3 #Only needed by bots keeping sessions on disk
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None) #Autocommit, save() uses its own transaction
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL") #A crash may lose the last spills, never corrupt the file
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, lastActivity REAL, userId INTEGER, chatId INTEGER, firstMessageId INTEGER, "
+            "botMessageId INTEGER, playerCount INTEGER, playerDeck INTEGER, tableCards INTEGER, deckMask INTEGER, actionStack TEXT, dataStack TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessionsByActivity ON sessions (lastActivity)")
+        self.insertQuery = "INSERT OR REPLACE INTO sessions (lastActivity, {}) VALUES ({})".format(", ".join(self.columns), ", ".join("?"*(len(self.columns)+1)))
+        self.selectQuery = "SELECT lastActivity, {} FROM sessions".format(", ".join(self.columns))
+    
+    def save(self, records:list)->None:
+        """Saves (lastActivity, record) tuples, replacing stored sessions with the same ID."""
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(self.insertQuery, [(lastActivity,)+tuple(record) for lastActivity, record in records])
+    
+    def pop(self, id:int):
+        """Removes the session with the given ID and returns it as (lastActivity, record), or None if it isn't stored."""
+        row = self.connection.execute(self.selectQuery+" WHERE id = ?", (id,)).fetchone()
+        if row is None: return None
+        self.connection.execute("DELETE FROM sessions WHERE id = ?", (id,))
+        return row[0], row[1:]
+    
+    def popExpired(self, before:float)->list:
+        """Removes the sessions last active before the given wall clock time and returns them as (lastActivity, record) tuples."""
+        rows = self.connection.execute(self.selectQuery+" WHERE lastActivity < ?", (before,)).fetchall()
+        if rows: self.connection.execute("DELETE FROM sessions WHERE lastActivity < ?", (before,))
+        return [(row[0], row[1:]) for row in rows]
+    
+    def getMaxId(self)->int:
+        """Returns the highest stored session ID (0 if there isn't any), new sessions have to use higher IDs."""
+        return self.connection.execute("SELECT MAX(id) FROM sessions").fetchone()[0] or 0
+    
+    def close(self)->None:
+        """Closes the file."""
+        self.connection.close()
+    
+    def __len__(self)->int:
+        """Number of stored sessions."""
+        return self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+class StoredMessage():
+    """Stands in for the Telegram messages kept by a session rebuilt from a SessionStore: only has the attributes sessions use."""
+    __slots__ = ("chat", "from_user", "id", "message_id")
+    _Chat = collections.namedtuple("Chat", "id")
+    _User = collections.namedtuple("User", "id")
+    
+    def __init__(self, chatId:int, messageId:int, userId:int=None):
+        """Initializes message messageId of chat chatId, sent by userId."""
+        self.chat = self._Chat(chatId)
+        self.from_user = self._User(userId)
+        self.id = self.message_id = messageId
+
+def _getObjectSize(obj, seen:set)->int:
+    """Approximate size of obj in bytes, including the objects it refers to (through containers, __dict__ and __slots__) not in seen."""
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_getObjectSize(key, seen)+_getObjectSize(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_getObjectSize(item, seen) for item in obj)
+    elif not isinstance(obj, type):
+        if hasattr(obj, "__dict__"): size += _getObjectSize(vars(obj), seen)
+        for cls in type(obj).__mro__: #Slot attributes, declared by each class of the hierarchy
+            slots = cls.__dict__.get("__slots__", ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                if name not in ("__dict__", "__weakref__") and hasattr(obj, name): size += _getObjectSize(getattr(obj, name), seen)
+    return size
+
+def compileFlow(expansions:dict)->dict:
+    """Flattens compound session actions: returns {action: tuple of elementary actions to push in its place}. An action appearing inside its own
+    expansion (a loop) is kept as is, so it's expanded again once it reaches the top of the stack."""
+    def flatten(action:str, expanding:tuple)->list:
+        if action not in expansions or action in expanding: return [action]
+        return [step for part in expansions[action] for step in flatten(part, expanding+(action,))]
+    return {action: tuple(flatten(action, ())) for action in expansions}
+
+#Inline keyboards: the few distinct layouts are built and serialized once (see KeyboardCache), with KEYBOARD_SESSION_PLACEHOLDER where callback data needs the session ID
+KEYBOARD_SESSION_PLACEHOLDER = "{session}"
+KEYBOARD_SUITES = ("S", "D", "H", "C") #Suite button order
+_SUITE_BUTTON_TEXTS = {"S": "Spades ♠", "D": "Diamonds ♦", "H": "Hearts ♥", "C": "Clubs ♣"}
+
+class KeyboardCache():
+    """Serialized inline keyboards, keyed by their builder function and its arguments, each built once. Telegram receives the serialized
+    markup as is, so showing a cached keyboard only costs joining its parts around the session ID. Keeps the maxSize most recently used ones."""
+    def __init__(self, maxSize:int=4096):
+        """Initializes an empty cache."""
+        self.maxSize = maxSize
+        self.templates = collections.OrderedDict() #(builder, arguments...) -> serialized markup split around the session ID placeholder
+        self.lock = threading.Lock()
+    
+    def get(self, sessionId:str, builder, *arguments)->str:
+        """Returns the serialized markup built by builder(*arguments), with sessionId in its callback data."""
+        key = (builder,)+arguments
+        with self.lock:
+            parts = self.templates.get(key)
+            if parts is not None:
+                self.templates.move_to_end(key)
+                return sessionId.join(parts)
+        parts = builder(*arguments).to_json().split(KEYBOARD_SESSION_PLACEHOLDER)
+        with self.lock:
+            self.templates[key] = parts
+            if len(self.templates) > self.maxSize: self.templates.popitem(last=False)
+        return sessionId.join(parts)
+
+def _sessionButton(text:str, data:str)->telebot.types.InlineKeyboardButton:
+    """Returns a button sending data to the session showing it."""
+    return _importTelebot().types.InlineKeyboardButton(text, callback_data=KEYBOARD_SESSION_PLACEHOLDER+"-"+data)
+
+def buildPlayerCountKeyboard()->telebot.types.InlineKeyboardMarkup:
+    """Opponent count selection keyboard."""
+    markup = _importTelebot().types.InlineKeyboardMarkup()
+    for i in range(1,6): #1 to 5 other players, might change later
+        markup.add(_sessionButton(str(i), "setPlayerCount-"+str(i)))
+    return markup
+
+def buildSuiteKeyboard(suitesLeft:tuple)->telebot.types.InlineKeyboardMarkup:
+    """Card suite selection keyboard, with a button for each suite of KEYBOARD_SUITES whose suitesLeft flag is True."""
+    markup = _importTelebot().types.InlineKeyboardMarkup()
+    for suite, isLeft in zip(KEYBOARD_SUITES, suitesLeft):
+        if isLeft: markup.add(_sessionButton(_SUITE_BUTTON_TEXTS[suite], "setSuite-"+suite))
+    return markup
+
+def buildValueKeyboard(valuesLeft:int)->telebot.types.InlineKeyboardMarkup:
+    """Card value selection keyboard, with a button for each value whose bit (value-2) is set in valuesLeft."""
+    markup = _importTelebot().types.InlineKeyboardMarkup(row_width=3)
+    for value in range(2, 15):
+        if valuesLeft >> (value-2) & 1:
+            markup.add(_sessionButton(str(value) if value <= 10 else "JQKA"[value-11], "setValue-"+str(value)))
+    return markup
+
+def buildMainMenuKeyboard(canReveal:bool, canReplay:bool)->telebot.types.InlineKeyboardMarkup:
+    """Main menu keyboard, offering to reveal a table card and to replay if allowed."""
+    markup = _importTelebot().types.InlineKeyboardMarkup()
+    if canReveal: markup.add(_sessionButton("Reveal a card on the table ➕", "mainMenuOnce-reveal"))
+    markup.add(_sessionButton("Start a new game (with a new deck) ♻️", "mainMenuOnce-retry"))
+    if canReplay: markup.add(_sessionButton("Replay another game (no cards thrown away) 🔄", "mainMenuOnce-replay"))
+    markup.add(_sessionButton("Quit ❌", "mainMenuOnce-quit"))
+    return markup
+
+keyboards = KeyboardCache()
 
 class Session():
     """Session storing a user interaction, game state and action stack."""
+    #Winning chance settings of the main menu: simulations stop at maxIterations, or once the standard error is below targetError,
+    #or after timeBudget seconds, whichever comes first (unless the result can be calculated exactly). Stratified simulations reach targetError sooner
+    maxIterations = 200000
+    targetError = 0.005
+    timeBudget = 1.0
+    stratify = True
+    
     def __init__(self, id: int, firstMessage: telebot.types.Message, parent: PokerBot):
         """Initialises session's identifying data and relationship with its parent PokerBot instance, as well as the game state and behavior parameters."""
         #Set identifying data
@@ -77,6 +868,8 @@ class Session():
         self.firstMessage = firstMessage
         self.parent = parent
         self.currentBotMessage = None
+        self.lock = threading.RLock() #Held while handling callbacks and while showing calculated winning chances
+        self.equityTicket = None #Pending winning chance calculation of the main menu, see showMainMenu()
         
         #Set working parameters
         self.actionStack = []
@@ -85,74 +878,54 @@ class Session():
         self.playerCount = None #NOTE: represents the number of opponents, doesn't include the user player
         self.playerDeck = []
         self.tableCards = []
-        self.fullDeck = Card.getDeck(None) #Call method without actually creating a Card object
+        self.fullDeckMask = FULL_DECK_MASK #Cards that haven't been used yet, see Card.mask
     
     def start(self)->None:
         """Initialises actionStack and sends 1st message asking for opponent count."""
-        self.actionStack = ["mainMenuLoop","loadCalculator","getPlayerDeckCard", "getPlayerDeckCard", "setPlayerCount"]
+        self.actionStack[:] = self.startFlow
+        self.showPlayerCountSelect()
+    
+    def showPlayerCountSelect(self)->None:
+        """Shows the opponent count selection menu as a new message (replacing the current bot message, if any)."""
         if self.currentBotMessage is not None: self.parent.bot.delete_message(chat_id=self.currentBotMessage.chat.id, message_id=self.currentBotMessage.id)
-        markup = telebot.types.InlineKeyboardMarkup()
-        for i in range(1,6): #1 to 5 other players, might change later
-            markup.add(telebot.types.InlineKeyboardButton(str(i), callback_data=self.idStr+"-setPlayerCount-"+str(i))) 
+        markup = keyboards.get(self.idStr, buildPlayerCountKeyboard)
         self.currentBotMessage = self.parent.bot.reply_to(self.firstMessage, "Before inputting your cards, how many other players are there?", reply_markup=markup)
     
     def callbackHandler(self, call: telebot.types.CallbackQuery, inputData: str)->None:
-        """Recursively handles user input relative to session, either by itself or by calling specific event handlers. See documentation for more details."""
+        """Handles user input relative to session (see handleAction()). Any pending winning chance calculation is cancelled, since the session moves on."""
+        with self.lock:
+            startTime = time.perf_counter()
+            self.cancelEquityJob()
+            self.handleAction(call, inputData)
+            if metrics.enabled:
+                action = inputData.split("-", 1)[0]
+                metrics.observe("pokerbot_callback_seconds", time.perf_counter()-startTime, action if action in self.flowSteps else "other") #Callback data comes from clients, only known actions get their own series
+    
+    def handleAction(self, call: telebot.types.CallbackQuery, inputData: str)->None:
+        """Runs the session flow (see flowExpansions and flowSteps) with the user input until an action needs more input.
+        Pops actions off the top (end) of actionStack: compound actions are replaced by their precompiled expansion, internal actions run right away,
+        and the first action asking for input either consumes the callback (if the callback is for that action) or shows its menu and stays on the stack."""
         #NOTE: all exceptions are normally handled by caller, no need to catch exceptions.
         if call.from_user.id != self.firstMessage.from_user.id:
             self.parent.bot.send_message(call.from_user.id, "Error: you're not allowed to edit that session!")
             raise PokerBotException("Callback user different from session creator!")
-        #Check the type of callback and dispatch accordingly
         action, data = inputData.split("-", 1)
-        assert self.actionStack #Assert action stack not empty (this should never raise an exception anyway)
-        self.actionStack, toPerform = self.actionStack[:-1], self.actionStack[-1]
-        transformTable = {"getPlayerDeckCard": ["setPlayerDeckCard","getCard"], "getTableCard": ["setTableCard","getCard"], "getCard":["setValue","setSuite"], "mainMenuLoop":["mainMenuLoop","mainMenuOnce"]}
-        while toPerform in transformTable: #Transform into elementary operations
-            self.actionStack += transformTable[toPerform]
-            self.actionStack, toPerform = self.actionStack[:-1], self.actionStack[-1]
-        #Then run elementary operation on "top" of stack (that is, end of list)
-        #If elementary operation requires no user input, do it and call ourselves again to do next step
-        #Then immediately return to not execute anything apart from calling self again (to avoid side effects from current iteraction)
-        if toPerform == "setPlayerDeckCard":
-            self.setPlayerDeckCardHandler(data)
-            self.callbackHandler(call, inputData)
-            return
-        elif toPerform == "setTableCard":
-            self.setTableCardHandler(data)
-            self.callbackHandler(call, inputData)
-            return
-        elif toPerform == "loadCalculator":
-            self.loadCalculatorHandler(data)
-            self.callbackHandler(call, inputData)
-            return
-        #For other operations, check if user callback input matches expected format
-        #NOTE: this will break if we do 2 identical elementary operations in a row (which should never happen anyway), be careful when managing stack
-        if action != toPerform:
-            #If it doesn't match, show the corresponding menu
-            if toPerform == "setPlayerCount":
-                self.start() #Displays player count selection menu
-            elif toPerform == "setSuite":
-                self.showSuiteSelect()
-            elif toPerform == "setValue":
-                self.showValueSelect()
-            elif toPerform == "mainMenuOnce":
-                self.showMainMenu()
-            #Put back the action to be handled on top of stack, since it hasn't been handled yet
-            self.actionStack.append(toPerform)
-        else:
-            #If it does match, save user data status and call self again
-            if toPerform == "setPlayerCount":
-                self.playerCountHandler(data)
-            elif toPerform == "setSuite":
-                self.setSuiteHandler(data)
-            elif toPerform == "setValue":
-                self.setValueHandler(data)
-            elif toPerform == "mainMenuOnce":
-                self.mainMenuOnceHandler(data)
-                if data == "quit": return #Don't do recursion if session just got removed, prevents exceptions
-            #Call ourselves again
-            #Since there aren't any 2 identical elementary actions in a row (at least I hope future me will be wise enough to make sure this never happens), the next action will be different and will display a menu
-            self.callbackHandler(call, inputData)
+        stack = self.actionStack
+        assert stack #Assert action stack not empty (this should never raise an exception anyway)
+        while stack: #An empty stack means the session has ended
+            toPerform = stack.pop()
+            expansion = self.flowExpansions.get(toPerform)
+            if expansion is not None:
+                stack.extend(expansion)
+                continue
+            showMenu, handler = self.flowSteps[toPerform]
+            if showMenu is not None: #Action needs user input
+                if action != toPerform: #Callback isn't (or no longer) for this action: wait for the user's input
+                    stack.append(toPerform)
+                    showMenu(self)
+                    return
+                action = None #The callback is consumed, the next action needing input shows its menu
+            handler(self, data)
 
     def mainMenuOnceHandler(self, data:str)->None:
         """Handles user input from main menu"""
@@ -163,20 +936,21 @@ class Session():
             self.actionStack.append("getTableCard")
         elif data == "retry":
             self.parent.bot.reply_to(self.firstMessage, "Restarting session...")
-            self.actionStack = ["mainMenuLoop","loadCalculator","getPlayerDeckCard", "getPlayerDeckCard", "setPlayerCount"]
+            self.actionStack[:] = self.startFlow
             self.dataStack = []
             self.playerCount = None
             self.playerDeck = []
             self.tableCards = []
-            self.fullDeck = Card.getDeck(None)
+            self.fullDeckMask = FULL_DECK_MASK
         elif data == "quit":
             self.parent.bot.reply_to(self.firstMessage, "Session ended successfully!")
             self.parent.bot.delete_message(chat_id=self.currentBotMessage.chat.id, message_id=self.currentBotMessage.id)
-            self.parent.sessions.remove(self) #We prevent exceptions when leaving by having specific return in callbackHandler()
+            self.parent.sessions.remove(self)
+            self.actionStack.clear() #Ends the session flow, see handleAction()
         elif data == "replay":
             """Difference between replay and retry is that retry asks for all parameters and resets everything, while replay just clears decks and table and allows to remember gone cards"""
             #Proper card count has been ensured by menu card counting
-            self.actionStack = ["mainMenuLoop","loadCalculator","getPlayerDeckCard", "getPlayerDeckCard"]
+            self.actionStack[:] = self.replayFlow
             self.playerDeck = []
             self.tableCards = []
             self.calculator = None
@@ -187,56 +961,93 @@ class Session():
         card = Card(suite, int(value))
         self.tableCards.append(card) #NOTE: not the same list object as self.calculator.tableCards
         self.calculator.updateState(self.playerCount, [card]) #Keep player count, add only the card we popped from the stack
-        self.fullDeck.remove(card)
+        self.fullDeckMask &= ~card.mask
 
     def showSuiteSelect(self)->None:
         """Shows the card suite selection menu."""
         #Check that cards of suites exist before giving option to user
-        suites = {card.suite for card in self.fullDeck}
-        markup = telebot.types.InlineKeyboardMarkup() #♠, ♥, ♦, ♣.
-        if "S" in suites: markup.add(telebot.types.InlineKeyboardButton("Spades ♠", callback_data=self.idStr+"-setSuite-S"))
-        if "D" in suites: markup.add(telebot.types.InlineKeyboardButton("Diamonds ♦", callback_data=self.idStr+"-setSuite-D"))
-        if "H" in suites: markup.add(telebot.types.InlineKeyboardButton("Hearts ♥", callback_data=self.idStr+"-setSuite-H"))
-        if "C" in suites: markup.add(telebot.types.InlineKeyboardButton("Clubs ♣", callback_data=self.idStr+"-setSuite-C"))
+        suitesLeft = tuple(bool(self.fullDeckMask & SUITE_MASKS[suite]) for suite in KEYBOARD_SUITES)
+        markup = keyboards.get(self.idStr, buildSuiteKeyboard, suitesLeft)
         #self.parent.bot.reply_to(self.firstMessage, "Select card suite", reply_markup=markup)
         self.parent.bot.edit_message_text("Select card suite", reply_markup=markup, chat_id=self.currentBotMessage.chat.id, message_id=self.currentBotMessage.id)
     
     def showValueSelect(self)->None:
         """Shows the card value selection value. Specifically omits values not in full deck to prevent cards being picked twice."""
         suite = self.dataStack[-1] #Should be defined by previous operation, no risk of error
-        markup = telebot.types.InlineKeyboardMarkup(row_width=3)
-        for i in range(2, 11):
-            if Card(suite, i) in self.fullDeck:
-                markup.add(telebot.types.InlineKeyboardButton(str(i), callback_data=self.idStr+"-setValue-"+str(i)))
-        for letter, value in [("J",11),("Q",12),("K",13),("A",14)]:
-            if Card(suite,value) in self.fullDeck:
-                markup.add(telebot.types.InlineKeyboardButton(letter, callback_data=self.idStr+"-setValue-"+str(value)))
+        valuesLeft = (self.fullDeckMask >> Card(suite, 2).index) & 0x1FFF #Bit value-2 is set if the card is still in the deck
+        markup = keyboards.get(self.idStr, buildValueKeyboard, valuesLeft)
         #self.parent.bot.reply_to(self.firstMessage, "Select card value", reply_markup=markup)
         self.parent.bot.edit_message_text("Select card value", reply_markup=markup, chat_id=self.currentBotMessage.chat.id, message_id=self.currentBotMessage.id)
 
     def showMainMenu(self)->None:
-        """Shows the game state's main menu with winning probability, current game state and action buttons as an inline keyboard."""
-        #First, calculate the winning probability
-        iterCount = 1000
-        winningChance = self.calculator.getWinningChance(iterCount)
-        #Then set up menu using known info
+        """Shows the game state's main menu with winning probability, current game state and action buttons as an inline keyboard.
+        Unless it's cached, the winning probability is calculated on the bot's compute threads: the menu says it's being calculated
+        until showMainMenuResult() shows it."""
+        self.cancelEquityJob()
+        self.equityTicket = self.parent.equityExecutor.submit(self.calculator, self.maxIterations, self.showMainMenuResult, targetError=self.targetError, timeBudget=self.timeBudget, stratify=self.stratify)
+        self.editMainMenu(self.equityTicket.result)
+    
+    def showMainMenuResult(self, ticket, result)->None:
+        """EquityExecutor callback, called from a compute thread: shows the calculated winning probability, unless the session moved on meanwhile."""
+        with self.lock:
+            if ticket.cancelled or ticket is not self.equityTicket: return
+            self.equityTicket = None
+            self.editMainMenu(result)
+    
+    def expire(self, notify:bool=True)->None:
+        """Stops the session once it's removed for inactivity: cancels any calculation and, if notify, edits the bot message to say so."""
+        with self.lock:
+            self.cancelEquityJob()
+            if notify and self.currentBotMessage is not None:
+                self.parent.bot.edit_message_text("This session has expired, use /start to start a new one!", chat_id=self.currentBotMessage.chat.id, message_id=self.currentBotMessage.id)
+    
+    def toRecord(self)->tuple:
+        """Returns the session's state as a compact tuple in SessionStore.columns order: IDs, card masks and the stacks as comma-separated strings."""
+        botMessageId = None if self.currentBotMessage is None else self.currentBotMessage.id
+        return (self.id, self.firstMessage.from_user.id, self.firstMessage.chat.id, self.firstMessage.message_id, botMessageId, self.playerCount,
+            Card.toMask(self.playerDeck), Card.toMask(self.tableCards), self.fullDeckMask, ",".join(self.actionStack), ",".join(self.dataStack))
+    
+    @classmethod
+    def fromRecord(cls, record:tuple, parent:PokerBot):
+        """Rebuilds a session saved by toRecord(), its Telegram messages being StoredMessage objects. Cards come back sorted by index."""
+        id, userId, chatId, firstMessageId, botMessageId, playerCount, playerDeck, tableCards, deckMask, actionStack, dataStack = record
+        session = cls(id, StoredMessage(chatId, firstMessageId, userId), parent)
+        if botMessageId is not None: session.currentBotMessage = StoredMessage(chatId, botMessageId)
+        session.playerCount = playerCount
+        session.playerDeck = Card.fromMask(playerDeck)
+        session.tableCards = Card.fromMask(tableCards)
+        session.fullDeckMask = deckMask
+        session.actionStack = actionStack.split(",") if actionStack else []
+        session.dataStack = dataStack.split(",") if dataStack else []
+        if len(session.playerDeck) == 2: #loadCalculator runs right after the player's 2nd card
+            session.calculator = PokerCalculator(playerCount, list(session.playerDeck), list(session.tableCards))
+        return session
+    
+    def cancelEquityJob(self)->None:
+        """Cancels the pending winning chance calculation of the main menu, if any."""
+        if self.equityTicket is not None:
+            self.equityTicket.cancel()
+            self.equityTicket = None
+    
+    def editMainMenu(self, result)->None:
+        """Edits the bot message into the main menu, showing the EquityResult result (or that it's being calculated if result is None)."""
+        if result is None:
+            winningChance = "calculating…"
+        else:
+            method = "exact, all outcomes" if result.isExact else "± {:.2f}%, simulated".format(1.96*result.standardError*100)
+            winningChance = "{:.2f}% ({})\nWon/tied/lost: {}/{}/{} out of {}".format(result.equity*100, method, result.wins, result.ties, result.losses, result.total)
+        #Set up menu using known info
         inviteText = """Number of opponents: {}
         
-Current winning chance : {}/{} ({}%)
+Current winning chance : {}
         
 Your cards: {} {}
         
 Cards on table: {}
         
-What do you want to do?""".format(self.playerCount, int(iterCount*winningChance), iterCount, winningChance*100, self.playerDeck[0].niceRepr(), self.playerDeck[1].niceRepr(), " ".join([card.niceRepr() for card in self.tableCards]))
-        #Then make the menu
-        markup = telebot.types.InlineKeyboardMarkup()
-        if len(self.tableCards) < 5: #Don't show button if all table cards are assigned
-            markup.add(telebot.types.InlineKeyboardButton("Reveal a card on the table ➕", callback_data=self.idStr+"-mainMenuOnce-reveal"))
-        markup.add(telebot.types.InlineKeyboardButton("Start a new game (with a new deck) ♻️", callback_data=self.idStr+"-mainMenuOnce-retry"))
-        if len(self.fullDeck) >= 7: #Make sure enough cards in the deck before offering a new game
-            markup.add(telebot.types.InlineKeyboardButton("Replay another game (no cards thrown away) 🔄", callback_data=self.idStr+"-mainMenuOnce-replay"))
-        markup.add(telebot.types.InlineKeyboardButton("Quit ❌", callback_data=self.idStr+"-mainMenuOnce-quit"))
+What do you want to do?""".format(self.playerCount, winningChance, self.playerDeck[0].niceRepr(), self.playerDeck[1].niceRepr(), " ".join([card.niceRepr() for card in self.tableCards]))
+        #Then make the menu: don't offer to reveal a card if all table cards are assigned, nor to replay without enough cards in the deck for a new game
+        markup = keyboards.get(self.idStr, buildMainMenuKeyboard, len(self.tableCards) < 5, self.fullDeckMask.bit_count() >= 7)
         # self.parent.bot.reply_to(self.firstMessage, inviteText, reply_markup=markup)
         self.parent.bot.edit_message_text(inviteText, reply_markup=markup, chat_id=self.currentBotMessage.chat.id, message_id=self.currentBotMessage.id)
 
@@ -257,23 +1068,67 @@ What do you want to do?""".format(self.playerCount, int(iterCount*winningChance)
         self.dataStack, suite, value = self.dataStack[:-2], self.dataStack[-2], self.dataStack[-1]
         card = Card(suite, int(value))
         self.playerDeck.append(card)
-        self.fullDeck.remove(card)
+        self.fullDeckMask &= ~card.mask
     
     def loadCalculatorHandler(self, data:str)->None:
         """Initializes the PokerCalculator object with current game state"""
         self.calculator = PokerCalculator(self.playerCount, self.playerDeck, self.tableCards)
+    
+    #Session flow, compiled once for all sessions. The action stack runs from its end: the last action of a flow runs first
+    startFlow = ("mainMenuLoop", "loadCalculator", "getPlayerDeckCard", "getPlayerDeckCard", "setPlayerCount")
+    replayFlow = ("mainMenuLoop", "loadCalculator", "getPlayerDeckCard", "getPlayerDeckCard")
+    #Compound actions -> elementary actions replacing them on the stack (mainMenuLoop pushes itself back under mainMenuOnce)
+    flowExpansions = compileFlow({"getPlayerDeckCard": ("setPlayerDeckCard", "getCard"), "getTableCard": ("setTableCard", "getCard"), "getCard": ("setValue", "setSuite"), "mainMenuLoop": ("mainMenuLoop", "mainMenuOnce")})
+    #Elementary actions -> (function showing the menu asking for the action's input, or None if it needs no input; function handling the input data)
+    flowSteps = {
+        "setPlayerCount": (showPlayerCountSelect, playerCountHandler),
+        "setSuite": (showSuiteSelect, setSuiteHandler),
+        "setValue": (showValueSelect, setValueHandler),
+        "mainMenuOnce": (showMainMenu, mainMenuOnceHandler),
+        "setPlayerDeckCard": (None, setPlayerDeckCardHandler),
+        "setTableCard": (None, setTableCardHandler),
+        "loadCalculator": (None, loadCalculatorHandler),
+    }
 
 class Card():
     """Represents a playing card. Suite is in ["C", "S", "D", "H"],
-        value is int. 2 <= value < 14."""
-    def __init__(self, suite:str, value:int):
-        """Assigns suite and value to card."""
-        self.suite = suite
-        self.value = value
+        value is int. 2 <= value <= 14.
+    Cards are interned: Card(suite, value) always returns the same object. Each card also carries its compact encoding,
+    index (0 to 51, in Card.getDeck() order) and mask (1 << index), used for 52-bit deck masks."""
+    __slots__ = ("suite", "value", "index", "mask")
+    _interned = {} #(suite, value) -> Card
+    _byIndex = [] #index -> Card
+
+    def __new__(cls, suite:str, value:int):
+        """Returns the interned card matching suite and value. Raises a PokerBotException if the card doesn't exist."""
+        try:
+            return cls._interned[(suite, value)]
+        except KeyError:
+            raise PokerBotException("Invalid card: {}{}".format(suite, value)) from None
+
+    @classmethod
+    def _intern(cls, suite:str, value:int):
+        """Creates the unique Card object for suite and value. Only used once per card when loading the module."""
+        card = object.__new__(cls)
+        card.suite = suite
+        card.value = value
+        card.index = len(cls._byIndex)
+        card.mask = 1 << card.index
+        cls._interned[(suite, value)] = card
+        cls._byIndex.append(card)
+        return card
     
     def __eq__(self, other)->bool:
-        """Compares equality between itself and another Card instance."""
-        return self.suite == other.suite and self.value == other.value
+        """Compares equality between itself and another Card instance. Cards are interned, so identity is enough."""
+        return self is other
+    
+    def __hash__(self)->int:
+        """Cards hash to their index."""
+        return self.index
+    
+    def __reduce__(self):
+        """Pickles cards by suite and value, so that unpickling returns the interned card."""
+        return (Card, (self.suite, self.value))
     
     def __repr__(self)->str:
         """Representation to show as command line text."""
@@ -289,17 +1144,401 @@ class Card():
         return value+suiteDict[self.suite]
     
     def getDeck(self)->list:
-        """Returns a full 52-card standard deck (list of Card objects)."""
-        deck = []
-        for suite in ["C", "H", "S", "D"]:
-            for value in range(2, 15):
-                deck.append(Card(suite, value))
-        return deck
+        """Returns a full 52-card standard deck (list of Card objects), sorted by index."""
+        return list(Card._byIndex)
+    
+    @staticmethod
+    def fromIndex(index:int):
+        """Returns the card with the given index (0 <= index < 52)."""
+        return Card._byIndex[index]
+    
+    @staticmethod
+    def fromString(text:str):
+        """Returns the card written as text: value then suite ("AS", "Td", "10h"), or repr() style suite then value ("S14")."""
+        text = text.strip().upper()
+        if len(text) >= 2 and text[0] in SUITES and text[1:].isdigit():
+            return Card(text[0], int(text[1:]))
+        value, suite = text[:-1], text[-1:]
+        letters = {"T":10, "J":11, "Q":12, "K":13, "A":14}
+        if value in letters: return Card(suite, letters[value])
+        if not value.isdigit(): raise PokerBotException("Invalid card: {}".format(text))
+        return Card(suite, int(value))
+    
+    @staticmethod
+    def toMask(cards:list)->int:
+        """Returns the deck mask containing the given cards."""
+        mask = 0
+        for card in cards:
+            mask |= card.mask
+        return mask
+    
+    @staticmethod
+    def fromMask(mask:int)->list:
+        """Returns the list of cards contained in a deck mask, sorted by index."""
+        cards = []
+        while mask:
+            lowBit = mask & -mask
+            cards.append(Card._byIndex[lowBit.bit_length()-1])
+            mask ^= lowBit
+        return cards
+
+for _suite in SUITES:
+    for _value in range(2, 15):
+        Card._intern(_suite, _value)
+del _suite, _value
+
+
+#Hand evaluation
+#Hands are ranked by an integer between 1 and HAND_RANK_COUNT (higher is better), computed with precomputed lookup tables:
+#flushes are looked up by the 13-bit mask of their values, other hands by their value histogram (3 bits per value, see _RANK_INC).
+#Each rank corresponds to a hand key (category << 20, then up to 5 tie-breaking values of 4 bits), keys are only used to build
+#the tables and to describe hands.
+HAND_CATEGORIES = ["High card", "Pair", "Two pair", "Three of a kind", "Straight", "Flush", "Full house", "Four of a kind", "Straight flush"]
+HAND_RANK_COUNT = 7462 #Number of distinct 5-card poker hands
+_VALUE_NAMES = {11:"J", 12:"Q", 13:"K", 14:"A"}
+_RANK_INC = [1 << (3*(card.value-2)) for card in Card._byIndex] #Value histogram increment of each card index
+_SUIT_INC = [1 << (4*SUITES.index(card.suite)) for card in Card._byIndex] #Suite count increment (4 bits per suite) of each card index
+_VALUE_BITS = [1 << (card.value-2) for card in Card._byIndex] #13-bit value mask of each card index
+_FLUSH_CHECK = 0x3333 #Adding 3 to each suite count sets the suite's high bit (see _FLUSH_BITS) only if it has 5 cards or more
+_FLUSH_BITS = 0x8888
+
+def _packKey(category:int, values:list)->int:
+    """Packs a hand category and its tie-breaking values (most significant first) into a comparable hand key."""
+    key = category
+    for i in range(5):
+        key = key*16 + (values[i] if i < len(values) else 0)
+    return key
+
+def _topValues(valueMask:int, count:int)->list:
+    """Returns the count highest values (2 to 14) present in a 13-bit value mask, highest first."""
+    values = []
+    for i in range(12, -1, -1):
+        if valueMask >> i & 1:
+            values.append(i+2)
+            if len(values) == count: break
+    return values
+
+def _straightHigh(valueMask:int)->int:
+    """Returns the high card value of the best straight in a 13-bit value mask, or 0 if there isn't any. Aces also count as 1."""
+    bits = (valueMask << 1) | (valueMask >> 12) #Bit n is now value n+1, bit 0 is the low ace
+    for high in range(14, 4, -1):
+        window = 0x1F << (high-5)
+        if bits & window == window: return high
+    return 0
+
+def _flushKey(valueMask:int)->int:
+    """Returns the hand key of the best hand made of cards of the same suite, given as a 13-bit value mask (5 bits or more)."""
+    high = _straightHigh(valueMask)
+    if high: return _packKey(8, [high])
+    return _packKey(5, _topValues(valueMask, 5))
+
+def _histogramKey(histogram:int)->int:
+    """Returns the hand key of the best non-flush hand of a value histogram (5 cards or more)."""
+    counts = [(histogram >> (3*i)) & 7 for i in range(13)]
+    present = [i+2 for i in range(12, -1, -1) if counts[i]] #Distinct values, highest first
+    quads = [value for value in present if counts[value-2] >= 4]
+    trips = [value for value in present if counts[value-2] == 3]
+    pairs = [value for value in present if counts[value-2] == 2]
+    kickers = lambda used, count: [value for value in present if value not in used][:count]
+    if quads:
+        return _packKey(7, [quads[0]]+kickers(quads[:1], 1))
+    if trips and (len(trips) > 1 or pairs):
+        return _packKey(6, [trips[0], max(trips[1:]+pairs)])
+    high = _straightHigh(sum(1 << (value-2) for value in present))
+    if high:
+        return _packKey(4, [high])
+    if trips:
+        return _packKey(3, [trips[0]]+kickers(trips, 2))
+    if len(pairs) >= 2:
+        return _packKey(2, pairs[:2]+kickers(pairs[:2], 1))
+    if pairs:
+        return _packKey(1, pairs[:1]+kickers(pairs, 3))
+    return _packKey(0, present[:5])
+
+def _buildHandTables():
+    """Enumerates every distinct 5-card hand and builds the rank tables. Only called once when loading the module."""
+    flushKeys = {}
+    histogramKeys = {}
+    for values in itertools.combinations(range(13), 5):
+        valueMask = sum(1 << i for i in values)
+        flushKeys[valueMask] = _flushKey(valueMask)
+    for values in itertools.combinations_with_replacement(range(13), 5):
+        if max(values.count(i) for i in values) > 4: continue
+        histogram = sum(1 << (3*i) for i in values)
+        histogramKeys[histogram] = _histogramKey(histogram)
+    handKeys = sorted(set(flushKeys.values()) | set(histogramKeys.values()))
+    assert len(handKeys) == HAND_RANK_COUNT
+    keyRanks = {key: rank for rank, key in enumerate(handKeys, 1)}
+    flushTable = [0]*8192
+    for valueMask, key in flushKeys.items():
+        flushTable[valueMask] = keyRanks[key]
+    histogramTable = {histogram: keyRanks[key] for histogram, key in histogramKeys.items()}
+    return [0]+handKeys, keyRanks, flushTable, histogramTable
+
+_HAND_KEYS, _KEY_RANKS, _FLUSH5, _HISTOGRAM5 = _buildHandTables()
+
+def evaluate5(indexes)->int:
+    """Returns the rank (1 to HAND_RANK_COUNT, higher is better) of a 5-card hand given as 5 card indexes."""
+    a, b, c, d, e = indexes
+    if (_SUIT_INC[a]+_SUIT_INC[b]+_SUIT_INC[c]+_SUIT_INC[d]+_SUIT_INC[e]+_FLUSH_CHECK) & _FLUSH_BITS:
+        return _FLUSH5[_VALUE_BITS[a]|_VALUE_BITS[b]|_VALUE_BITS[c]|_VALUE_BITS[d]|_VALUE_BITS[e]]
+    return _HISTOGRAM5[_RANK_INC[a]+_RANK_INC[b]+_RANK_INC[c]+_RANK_INC[d]+_RANK_INC[e]]
+
+def _buildFlush7Table()->list:
+    """Builds the table of the best same-suite hand of every 13-bit value mask with 5 bits or more (up to 7 cards of a suite)."""
+    table = [0]*8192
+    for valueMask in range(8192):
+        if valueMask.bit_count() >= 5:
+            table[valueMask] = _KEY_RANKS[_flushKey(valueMask)]
+    return table
+
+_FLUSH7 = _buildFlush7Table()
+_HISTOGRAM7 = dict(_HISTOGRAM5) #Ranks of non-flush histograms of 5 to 7 cards, filled lazily (at most 49205 7-card entries)
+
+def _histogramRank(histogram:int)->int:
+    """Computes, stores and returns the rank of a value histogram missing from _HISTOGRAM7."""
+    rank = _HISTOGRAM7[histogram] = _KEY_RANKS[_histogramKey(histogram)]
+    return rank
+
+def evaluate7(indexes)->int:
+    """Returns the rank of the best 5-card hand among 5 to 7 card indexes, without enumerating 5-card subsets.
+    Flushes are detected with the suite counts and looked up by value mask, other hands by value histogram."""
+    histogram = 0
+    suites = _FLUSH_CHECK
+    for i in indexes:
+        histogram += _RANK_INC[i]
+        suites += _SUIT_INC[i]
+    flushBits = suites & _FLUSH_BITS
+    if flushBits: #Only one suite can have 5 cards out of 7, and a flush always beats the non-flush hands of the same cards
+        suiteIndex = (flushBits.bit_length()-4) >> 2
+        valueMask = 0
+        for i in indexes:
+            if i // 13 == suiteIndex: valueMask |= _VALUE_BITS[i]
+        return _FLUSH7[valueMask]
+    rank = _HISTOGRAM7.get(histogram)
+    return rank if rank is not None else _histogramRank(histogram)
+
+def evaluateHands(board, hands)->list:
+    """Returns the ranks of several 2-card hands (pairs of card indexes) sharing the same 5-card board, in the same order.
+    The board's histogram, suite counts and suite value masks are computed only once."""
+    boardHistogram = 0
+    boardSuites = _FLUSH_CHECK
+    boardValues = [0, 0, 0, 0]
+    for i in board:
+        boardHistogram += _RANK_INC[i]
+        boardSuites += _SUIT_INC[i]
+        boardValues[i // 13] |= _VALUE_BITS[i]
+    ranks = []
+    for a, b in hands:
+        flushBits = (boardSuites+_SUIT_INC[a]+_SUIT_INC[b]) & _FLUSH_BITS
+        if flushBits:
+            suiteIndex = (flushBits.bit_length()-4) >> 2
+            valueMask = boardValues[suiteIndex]
+            if a // 13 == suiteIndex: valueMask |= _VALUE_BITS[a]
+            if b // 13 == suiteIndex: valueMask |= _VALUE_BITS[b]
+            ranks.append(_FLUSH7[valueMask])
+        else:
+            histogram = boardHistogram+_RANK_INC[a]+_RANK_INC[b]
+            rank = _HISTOGRAM7.get(histogram)
+            ranks.append(rank if rank is not None else _histogramRank(histogram))
+    return ranks
+
+_batchTables = None
+
+def _getBatchTables():
+    """Returns the numpy lookup arrays used by evaluate7Batch(), building them on first use (takes a fraction of a second).
+    Non-flush ranks are stored for every 7-card value histogram, sorted by histogram so they can be found with searchsorted."""
+    global _batchTables
+    if _batchTables is None:
+        histograms = []
+        for values in itertools.combinations_with_replacement(range(13), 7):
+            if max(values.count(i) for i in set(values)) > 4: continue
+            histograms.append(sum(1 << (3*i) for i in values))
+        histograms.sort()
+        ranks = [_HISTOGRAM7.get(histogram) or _histogramRank(histogram) for histogram in histograms]
+        _batchTables = (
+            numpy.array(histograms, dtype=numpy.int64),
+            numpy.array(ranks, dtype=numpy.int16),
+            numpy.array(_FLUSH7, dtype=numpy.int16),
+            numpy.array(_RANK_INC, dtype=numpy.int64),
+            numpy.array(_SUIT_INC, dtype=numpy.int64),
+            numpy.array(_VALUE_BITS, dtype=numpy.int64),
+        )
+    return _batchTables
+
+def evaluate7Batch(cards):
+    """Vectorized evaluate7(): cards is an integer numpy array of shape (N, 7) of card indexes, returns the N hand ranks."""
+    histogramKeys, histogramRanks, flushTable, rankInc, suitInc, valueBits = _getBatchTables()
+    ranks = histogramRanks[numpy.searchsorted(histogramKeys, rankInc[cards].sum(axis=1))]
+    flushBits = (suitInc[cards].sum(axis=1)+_FLUSH_CHECK) & _FLUSH_BITS
+    flushRows = numpy.nonzero(flushBits)[0]
+    if len(flushRows):
+        flushCards = cards[flushRows]
+        suiteIndex = (flushBits[flushRows] >= 0x80).astype(numpy.int64)+(flushBits[flushRows] >= 0x800)+(flushBits[flushRows] >= 0x8000)
+        valueMask = numpy.where(flushCards // 13 == suiteIndex[:, None], valueBits[flushCards], 0).sum(axis=1)
+        ranks[flushRows] = flushTable[valueMask]
+    return ranks
+
+def evaluateHandsBatch(boards, hands):
+    """Vectorized evaluateHands(): boards is an integer numpy array of shape (B, 5) of card indexes, hands one of shape (K, 2) (the same hands on
+    every board) or (B, K, 2) (different hands on each board). Returns the (B, K) hand ranks. Each board's histogram, suite counts and
+    suite value masks are computed once, then added to each hand's."""
+    histogramKeys, histogramRanks, flushTable, rankInc, suitInc, valueBits = _getBatchTables()
+    if hands.ndim == 2: hands = hands[None]
+    first, second = hands[..., 0], hands[..., 1]
+    boardRows = numpy.arange(len(boards))
+    boardValues = numpy.zeros((len(boards), 4), dtype=numpy.int64) #Value mask of each suite
+    for column in boards.T:
+        boardValues[boardRows, column // 13] |= valueBits[column]
+    ranks = histogramRanks[numpy.searchsorted(histogramKeys, rankInc[boards].sum(axis=1)[:, None]+rankInc[first]+rankInc[second])]
+    flushBits = (suitInc[boards].sum(axis=1)[:, None]+_FLUSH_CHECK+suitInc[first]+suitInc[second]) & _FLUSH_BITS
+    flushRows, flushColumns = numpy.nonzero(flushBits)
+    if len(flushRows):
+        bits = flushBits[flushRows, flushColumns]
+        suiteIndex = (bits >= 0x80).astype(numpy.int64)+(bits >= 0x800)+(bits >= 0x8000)
+        a = numpy.broadcast_to(first, ranks.shape)[flushRows, flushColumns]
+        b = numpy.broadcast_to(second, ranks.shape)[flushRows, flushColumns]
+        valueMask = boardValues[flushRows, suiteIndex] | numpy.where(a // 13 == suiteIndex, valueBits[a], 0) | numpy.where(b // 13 == suiteIndex, valueBits[b], 0)
+        ranks[flushRows, flushColumns] = flushTable[valueMask]
+    return ranks
+
+def describeRank(rank:int)->str:
+    """Returns a human-readable description of a hand rank, like "Full house, K full of 9". Slow, meant for display only."""
+    key = _HAND_KEYS[rank]
+    category = key >> 20
+    values = [(key >> (4*i)) & 0xF for i in range(4, -1, -1)]
+    names = [_VALUE_NAMES.get(value, str(value)) for value in values if value]
+    if category == 8: return "Straight flush, {} high".format(names[0])
+    if category == 7: return "Four of a kind, {} with {} kicker".format(*names)
+    if category == 6: return "Full house, {} full of {}".format(*names)
+    if category == 5: return "Flush, {}".format("-".join(names))
+    if category == 4: return "Straight, {} high".format(names[0])
+    if category == 3: return "Three of a kind, {} with {}".format(names[0], "-".join(names[1:]))
+    if category == 2: return "Two pair, {} and {} with {} kicker".format(*names)
+    if category == 1: return "Pair of {} with {}".format(names[0], "-".join(names[1:]))
+    return "High card, {}".format("-".join(names))
+
+
+#Parallel simulations
+_processPool = None
+_processPoolWorkers = 0
+_processPoolLock = threading.Lock()
+
+def getProcessPool(workers:int)->concurrent.futures.ProcessPoolExecutor:
+    """Returns the shared simulation process pool, (re)creating it only if it doesn't exist or has a different worker count.
+    Workers are spawned rather than forked, since forking a process running telebot's threads isn't safe."""
+    global _processPool, _processPoolWorkers
+    with _processPoolLock:
+        if _processPool is None or _processPoolWorkers != workers:
+            if _processPool is not None: _processPool.shutdown(wait=False)
+            _processPool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+            _processPoolWorkers = workers
+        return _processPool
+
+def shutdownProcessPool()->None:
+    """Shuts down the shared simulation process pool, if any."""
+    global _processPool, _processPoolWorkers
+    with _processPoolLock:
+        if _processPool is not None: _processPool.shutdown()
+        _processPool, _processPoolWorkers = None, 0
+
+def _deriveSeed(seed:int, *path)->int:
+    """Derives an independent 64-bit seed from the simulation seed and a path, like (worker count, worker index) for a worker's random stream."""
+    digest = hashlib.sha256("-".join(str(part) for part in (seed,)+path).encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+def _simulateChunk(state:tuple, iterationCount:int, engine:str, seed:int, stratify:bool=False):
+    """Process pool task: rebuilds a calculator from (otherPlayerCount, playerDeck indexes, tableCards indexes) and returns its simulation's EquityResult."""
+    otherPlayerCount, playerDeck, tableCards = state
+    calculator = PokerCalculator(otherPlayerCount, [Card.fromIndex(i) for i in playerDeck], [Card.fromIndex(i) for i in tableCards])
+    return calculator._simulate(iterationCount, engine, seed, stratify)
+
+
+class EquityResult():
+    """Result of a winning chance calculation: numbers of won, tied and lost games, and the player's summed pot shares
+    (1 per won game, 1/n per game split between n players) and squared shares, used for the simulation's standard error.
+    Results of the same game state can be merged with add()."""
+    def __init__(self, wins:int=0, ties:int=0, losses:int=0, shares:float=0.0, squaredShares:float=0.0, isExact:bool=False, varianceSum:float=None):
+        """Initializes result with game counts. isExact tells if every possible outcome was counted (rather than sampled).
+        varianceSum is given by stratified simulations: the sum over strata of (stratum game count)*(variance of a game's share within the stratum).
+        Without it, games are assumed to be plain random samples."""
+        self.wins = wins
+        self.ties = ties
+        self.losses = losses
+        self.shares = shares
+        self.squaredShares = squaredShares
+        self.isExact = isExact
+        self.varianceSum = varianceSum
+    
+    @property
+    def total(self)->int:
+        """Number of games counted."""
+        return self.wins+self.ties+self.losses
+    
+    @property
+    def equity(self)->float:
+        """Player's expected share of the pot, between 0 and 1 (ties count as partial wins)."""
+        return self.shares/self.total if self.total else 0.0
+    
+    @property
+    def iterations(self)->int:
+        """Number of simulated games (same as total, 0 for exact results)."""
+        return 0 if self.isExact else self.total
+    
+    @property
+    def sampleVariance(self)->float:
+        """Variance of a game's share over all games (infinite with less than 2 games)."""
+        if self.total < 2: return math.inf
+        return max((self.squaredShares-self.shares*self.shares/self.total)/(self.total-1), 0.0)
+    
+    @property
+    def standardError(self)->float:
+        """Standard error of the equity estimate (0 for exact results, infinite without any game)."""
+        if self.isExact: return 0.0
+        if self.total < 2: return math.inf
+        if self.varianceSum is not None: return math.sqrt(self.varianceSum)/self.total
+        return math.sqrt(self.sampleVariance/self.total)
+    
+    @property
+    def effectiveSampleSize(self)->float:
+        """Number of plain random games giving the same standard error: the game count for plain simulations, more for stratified ones (infinite for exact results)."""
+        if self.isExact: return math.inf
+        if self.varianceSum is None or self.total < 2: return self.total
+        return self.sampleVariance*self.total*self.total/self.varianceSum if self.varianceSum else math.inf
+    
+    def confidenceInterval(self, z:float=1.96)->tuple:
+        """Returns the (low, high) confidence interval of the equity, by default at 95%, clipped to [0, 1]."""
+        margin = z*self.standardError
+        return max(0.0, self.equity-margin), min(1.0, self.equity+margin)
+    
+    def add(self, other)->None:
+        """Adds the counts of another result of the same game state (e.g. from another worker or batch).
+        When merging stratified and plain results, plain ones count as a single stratum."""
+        if self.varianceSum is not None or other.varianceSum is not None:
+            self.varianceSum = self._getVarianceSum()+other._getVarianceSum()
+        self.wins += other.wins
+        self.ties += other.ties
+        self.losses += other.losses
+        self.shares += other.shares
+        self.squaredShares += other.squaredShares
+    
+    def _getVarianceSum(self)->float:
+        """Returns varianceSum, computed as for a single stratum for plain results."""
+        if self.varianceSum is not None: return self.varianceSum
+        return self.total*self.sampleVariance if self.total >= 2 else 0.0
+    
+    def __repr__(self)->str:
+        """Representation to show as command line text."""
+        return "EquityResult(equity={:.4f}, standardError={:.4f}, wins={}, ties={}, losses={}, isExact={})".format(self.equity, self.standardError, self.wins, self.ties, self.losses, self.isExact)
 
 
 class PokerCalculator():
     """Class responsible for doing all math operations relative to game state.
     Assignment state (with bool attribute isAssigned) largely determines what is allowed and what isn't."""
+    exactThreshold = 1000000 #Default maximum number of outcomes for getEquity() to enumerate them exactly instead of simulating
+    minStratumSize = 2 #Minimum number of games per stratum of stratified simulations (its variance needs 2), see _getStrata()
+    firstBatchSize = 1000 #Size of the first batch of adaptive simulations (see getEquity()), later batches grow from there
+    
     def __init__(self, otherPlayerCount: int, playerDeck: list, tableCards=[]):
         """Initializes PokerCalculator with game state."""
         self.otherPlayerCount = otherPlayerCount
@@ -307,34 +1546,41 @@ class PokerCalculator():
         self.tableCards = tableCards.copy() #Make sure it's a different object to avoid unexpected behavior
         self.otherPlayerDecks = []
         self.isAssigned = False
+        self.rng = random #Random source of pickCard(), anything with a random() method
+        self._deckBuffer = None #Remaining card indexes, reused (in any order) by the inplace engine while deckMask doesn't change
+        self._deckBufferMask = None
         
-        #Generate a full standard deck, then remove all cards already displayed
-        self.deck = Card.getDeck(None)
-        
+        #Start from a full standard deck mask, then remove all cards already displayed
+        self.deckMask = FULL_DECK_MASK
         for card in playerDeck+tableCards:
-            #print("playerDeck, tableCards:", playerDeck, tableCards) #DEBUG
-            #print("Current deck:", self.deck) #DEBUG
-            self.deck.remove(card)
+            if not self.deckMask & card.mask: raise PokerBotException("Can't use the same card twice!")
+            self.deckMask ^= card.mask
+    
+    @property
+    def deck(self)->list:
+        """List of the cards remaining in the deck (built from deckMask, prefer using the mask directly)."""
+        return Card.fromMask(self.deckMask)
     
     def updateState(self, newOtherPlayerCount: int, newTableCards: list):
         """Updates internal state according to new information. Calculator must not already be assigned. newTableCards cannot contain any cards that are already used."""
         if self.isAssigned: raise PokerBotException("Can't update an assigned deck!")
+        newMask = Card.toMask(newTableCards)
+        if newMask & ~self.deckMask or newMask.bit_count() != len(newTableCards):
+            raise PokerBotException("newTableCards can't contain any already used cards.")
         self.otherPlayerCount = newOtherPlayerCount
         self.tableCards += newTableCards
-        try:
-            for card in newTableCards:
-                self.deck.remove(card)
-        except:
-            raise PokerBotException("newTableCards can't contain any already used cards.")
+        self.deckMask ^= newMask
 
     
     def pickCard(self):
-        """Picks a card from the deck, removes it from the deck and returns it."""
-        try:
-            card = random.choice(self.deck)
-        except IndexError:
+        """Picks a card from the deck, removes it from the deck and returns it.
+        Uses rejection sampling on the deck mask, which takes O(1) tries as long as the deck isn't almost empty."""
+        if not self.deckMask:
             raise PokerBotException("Can't pick a card from an empty deck!")
-        self.deck.remove(card)
+        while True:
+            card = Card._byIndex[int(self.rng.random()*52)]
+            if self.deckMask & card.mask: break
+        self.deckMask ^= card.mask
         return card
 
     def assignRandomCards(self):
@@ -349,186 +1595,775 @@ class PokerCalculator():
     def copy(self):
         """Returns a (deep) copy of the calculator; useful for making simulations. Calculator must not be assigned."""
         if not self.isAssigned:
-            return PokerCalculator(self.otherPlayerCount, self.playerDeck.copy(), self.tableCards.copy())
+            copy = PokerCalculator(self.otherPlayerCount, self.playerDeck.copy(), self.tableCards.copy())
+            copy.rng = self.rng
+            return copy
         raise PokerBotException("Can't copy an assigned poker layout!")
 
-    def getWinningChance(self, iterationCount=1000):
-        """Calculates a simulation over iterationCount iterations and returns the proportion of won games as a float beteen 0 and 1. Calculator must not be assigned!"""
+    def getWinningChance(self, iterationCount=1000, engine=None, seed=None, workers=None, exactThreshold=None, targetError=None, timeBudget=None, stratify=False)->float:
+        """Returns the player's winning chance as a float beteen 0 and 1 (ties count as partial wins). Calculator must not be assigned!
+        See getEquity() for parameters, and to also get win/tie/loss counts, the confidence interval and the number of iterations used."""
+        return self.getEquity(iterationCount, engine, seed, workers, exactThreshold, targetError, timeBudget, stratify=stratify).equity
+    
+    def getEquity(self, iterationCount=1000, engine=None, seed=None, workers=None, exactThreshold=None, targetError=None, timeBudget=None, batchSize=None, cancelEvent=None, stratify=False)->EquityResult:
+        """Calculates the player's winning chance and returns it as an EquityResult. Calculator must not be assigned!
+        If the number of possible outcomes (see estimateEnumerationSize()) is at most exactThreshold (default: PokerCalculator.exactThreshold),
+        every outcome is enumerated for an exact result. Otherwise, runs a simulation over iterationCount iterations:
+        engine is "numpy" (batched, default when numpy is installed), "inplace" (default without numpy, see _simulateInPlace())
+        or "reference" (one assigned copy of the calculator per iteration).
+        Giving a seed makes the result reproducible. With workers > 1, iterations are split across a shared process pool, each worker
+        getting its own random stream derived from (seed, workers, worker index), so a given seed and worker count always give the same result.
+        With a targetError (standard error of the equity) and/or a timeBudget (seconds), iterations are run by batches of batchSize
+        until the standard error gets below targetError or the time budget is spent, iterationCount being the maximum iteration count.
+        Without a batchSize, the first batch has firstBatchSize iterations and each next one is sized to reach targetError, at most doubling
+        the iterations so far: clear-cut spots stop after a few thousand iterations, close ones run as many as they need.
+        Setting cancelEvent (a threading.Event) stops simulations between batches, returning what was simulated so far.
+        With stratify, simulations (numpy and inplace engines) are stratified over the first missing table cards (see _getStrata()): every possible
+        runout of those cards gets the same number of games, which removes their share of the variance. The result's effectiveSampleSize tells
+        how many plain random games it's worth."""
+        if not metrics.enabled:
+            return self._calculateEquity(iterationCount, engine, seed, workers, exactThreshold, targetError, timeBudget, batchSize, cancelEvent, stratify)
+        startTime = time.perf_counter()
+        result = self._calculateEquity(iterationCount, engine, seed, workers, exactThreshold, targetError, timeBudget, batchSize, cancelEvent, stratify)
+        duration = time.perf_counter()-startTime
+        metrics.observe("pokerbot_equity_seconds", duration)
+        metrics.increment("pokerbot_equity_iterations_total", result.total)
+        metrics.increment("pokerbot_hand_evaluations_total", result.total*(self.otherPlayerCount+1)) #Simulation engines score hands without getScore()
+        if duration > 0: metrics.observe("pokerbot_equity_iterations_per_second", result.total/duration)
+        return result
+    
+    def _calculateEquity(self, iterationCount, engine, seed, workers, exactThreshold, targetError, timeBudget, batchSize, cancelEvent, stratify)->EquityResult:
+        """Calculates getEquity()'s result, without recording metrics."""
         if self.isAssigned:
             raise PokerBotException("Can't start analysis on already assigned decks!")
-        wonGames = 0
+        if exactThreshold is None:
+            exactThreshold = self.exactThreshold
+        if self.estimateEnumerationSize() <= exactThreshold:
+            return self.enumerateEquity()
+        if engine is None:
+            engine = "inplace" if numpy is None else "numpy"
+        if engine not in ("numpy", "inplace", "reference"):
+            raise PokerBotException("Unknown simulation engine: {}".format(engine))
+        if stratify and engine == "reference":
+            raise PokerBotException("Stratified simulations need the numpy or inplace engine")
+        if cancelEvent is not None and cancelEvent.is_set():
+            return EquityResult()
+        if targetError is None and timeBudget is None:
+            return self._runSimulation(iterationCount, engine, seed, workers, stratify)
+        startTime = time.monotonic()
+        result = EquityResult()
+        batchIndex = 0
+        nextBatchSize = self.firstBatchSize if batchSize is None else batchSize
+        while result.total < iterationCount:
+            batchSeed = None if seed is None else _deriveSeed(seed, "batch", batchIndex)
+            result.add(self._runSimulation(min(nextBatchSize, iterationCount-result.total), engine, batchSeed, workers, stratify))
+            batchIndex += 1
+            if targetError is not None and result.standardError <= targetError: break
+            if timeBudget is not None and time.monotonic()-startTime >= timeBudget: break
+            if cancelEvent is not None and cancelEvent.is_set(): break
+            if batchSize is None: #Iterations needed for targetError, estimated from the standard error so far (it decreases as 1/sqrt(iterations))
+                neededCount = result.total if targetError is None else math.ceil(result.total*(result.standardError/targetError)**2)-result.total
+                nextBatchSize = max(self.firstBatchSize, min(neededCount, result.total))
+        return result
+    
+    def _runSimulation(self, iterationCount:int, engine:str, seed=None, workers=None, stratify:bool=False)->EquityResult:
+        """Runs iterationCount simulations, split across the shared process pool if workers > 1 (see getEquity())."""
+        if not workers or workers <= 1:
+            return self._simulate(iterationCount, engine, seed, stratify)
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        state = (self.otherPlayerCount, [card.index for card in self.playerDeck], [card.index for card in self.tableCards])
+        pool = getProcessPool(workers)
+        futures = []
+        for i in range(workers):
+            chunk = iterationCount // workers + (1 if i < iterationCount % workers else 0)
+            futures.append(pool.submit(_simulateChunk, state, chunk, engine, _deriveSeed(seed, workers, i), stratify))
+        result = EquityResult()
+        for future in futures:
+            result.add(future.result())
+        return result
+    
+    def estimateEnumerationSize(self)->int:
+        """Returns the number of possible outcomes (missing table cards, then ordered opponent hands) given the known cards."""
+        remaining = self.deckMask.bit_count()
+        tableCount = 5-len(self.tableCards)
+        size = math.comb(remaining, tableCount)
+        remaining -= tableCount
+        for _ in range(self.otherPlayerCount):
+            size *= math.comb(remaining, 2)
+            remaining -= 2
+        return size
+    
+    def enumerateEquity(self)->EquityResult:
+        """Counts every possible outcome and returns the exact EquityResult. Cost grows with estimateEnumerationSize(), see getEquity()."""
+        if self.isAssigned:
+            raise PokerBotException("Can't start analysis on already assigned decks!")
+        remaining = [card.index for card in Card.fromMask(self.deckMask)]
+        playerDeck = [card.index for card in self.playerDeck]
+        knownTable = [card.index for card in self.tableCards]
+        result = EquityResult(isExact=True)
+        for drawnTable in itertools.combinations(remaining, 5-len(knownTable)):
+            table = knownTable+list(drawnTable)
+            playerScore = evaluate7(playerDeck+table)
+            drawnMask = sum(1 << i for i in drawnTable)
+            otherDecks = [deck for deck in itertools.combinations(remaining, 2) if not (1 << deck[0] | 1 << deck[1]) & drawnMask]
+            otherScores = evaluateHands(table, otherDecks)
+            otherDecks = [(1 << a | 1 << b, score) for (a, b), score in zip(otherDecks, otherScores)]
+            self._enumerateOtherDecks(result, otherDecks, playerScore, self.otherPlayerCount, 0, 0, 0)
+        return result
+    
+    def _enumerateOtherDecks(self, result:EquityResult, otherDecks:list, playerScore:int, playerCount:int, usedMask:int, bestScore:int, tiedCount:int)->None:
+        """Recursively deals playerCount more opponent hands from otherDecks ((mask, score) tuples) and counts outcomes into result."""
+        if playerCount == 0:
+            if playerScore > bestScore:
+                result.wins += 1
+                result.shares += 1
+            elif playerScore == bestScore:
+                result.ties += 1
+                result.shares += 1/(1+tiedCount)
+            else:
+                result.losses += 1
+            return
+        if playerCount == 1: #Count the last opponent's hands directly, this is where most outcomes are
+            for mask, score in otherDecks:
+                if mask & usedMask: continue
+                if score > playerScore or bestScore > playerScore:
+                    result.losses += 1
+                elif score < playerScore and bestScore < playerScore:
+                    result.wins += 1
+                    result.shares += 1
+                else:
+                    result.ties += 1
+                    result.shares += 1/(1+tiedCount+(score == playerScore))
+            return
+        for mask, score in otherDecks:
+            if mask & usedMask: continue
+            self._enumerateOtherDecks(result, otherDecks, playerScore, playerCount-1, usedMask | mask, max(bestScore, score), tiedCount+(score == playerScore))
+    
+    def _simulate(self, iterationCount:int, engine:str, seed=None, stratify:bool=False)->EquityResult:
+        """Runs iterationCount simulations with the given engine and random seed (None for an unseeded run), returns the EquityResult.
+        With stratify, the numpy and inplace engines run a stratified simulation (see _getStrata())."""
+        strata = self._getStrata(iterationCount, seed) if stratify else None
+        if engine == "numpy":
+            return self._simulateBatched(iterationCount, seed, strata=strata)
+        if engine == "inplace":
+            return self._simulateInPlace(iterationCount, seed, strata)
+        rng = random if seed is None else random.Random(seed)
+        result = EquityResult()
         for _ in range(iterationCount):
             copy = self.copy()
+            copy.rng = rng
             copy.assignRandomCards()
-            if copy.isWinning():
-                wonGames += 1
-        return wonGames / iterationCount
+            share = copy.isWinning()
+            if share == 1:
+                result.wins += 1
+            elif share:
+                result.ties += 1
+            else:
+                result.losses += 1
+            result.shares += share
+            result.squaredShares += share*share
+        return result
+    
+    def _getStrata(self, iterationCount:int, seed=None)->list:
+        """Returns the strata of a stratified simulation of iterationCount games, as (card indexes, game count) tuples: one stratum per combination
+        of the first missing table cards, using as many of them as possible while keeping at least minStratumSize games per stratum.
+        Each stratum gets the same number of games, the remainder going to randomly chosen strata (so every stratum keeps the same expected weight).
+        Returns None if there's no table card missing, or too few games to stratify."""
+        remaining = [card.index for card in Card.fromMask(self.deckMask)]
+        depth = 0
+        while depth < 5-len(self.tableCards) and math.comb(len(remaining), depth+1)*self.minStratumSize <= iterationCount:
+            depth += 1
+        if depth == 0: return None
+        strata = list(itertools.combinations(remaining, depth))
+        sizes = [iterationCount // len(strata)]*len(strata)
+        rng = random if seed is None else random.Random(_deriveSeed(seed, "strata"))
+        for i in rng.sample(range(len(strata)), iterationCount % len(strata)):
+            sizes[i] += 1
+        return list(zip(strata, sizes))
+    
+    def _simulateInPlace(self, iterationCount:int, seed=None, strata:list=None)->EquityResult:
+        """inplace engine of _simulate(): deals each runout with a partial Fisher-Yates shuffle of the calculator's buffer of remaining
+        card indexes (the first cards of the buffer are the missing table cards, then 2 cards per opponent), and scores hands directly
+        from the buffer. The steady-state loop doesn't create any list, Card or calculator (only Python's temporary numbers).
+        With strata (see _getStrata()), each stratum's cards are moved to the front of the buffer and only the cards after them are shuffled."""
+        randomFloat = (random if seed is None else random.Random(seed)).random
+        if self._deckBufferMask != self.deckMask:
+            self._deckBuffer = [card.index for card in Card.fromMask(self.deckMask)]
+            self._deckBufferMask = self.deckMask
+        deck = self._deckBuffer
+        deck.sort() #Start from the same order on each call, so seeded results are reproducible
+        deckSize = len(deck)
+        tableCount = 5-len(self.tableCards)
+        drawCount = tableCount+2*self.otherPlayerCount
+        if drawCount > deckSize: raise PokerBotException("Not enough cards in the deck for that many players!")
+        knownHistogram = 0
+        knownSuites = _FLUSH_CHECK
+        knownValues = [0, 0, 0, 0]
+        for card in self.tableCards:
+            knownHistogram += _RANK_INC[card.index]
+            knownSuites += _SUIT_INC[card.index]
+            knownValues[card.index // 13] |= _VALUE_BITS[card.index]
+        playerA, playerB = [card.index for card in self.playerDeck]
+        tableRange = range(tableCount)
+        otherRange = range(tableCount, drawCount, 2)
+        
+        def score(histogram:int, suites:int, a:int, b:int)->int:
+            """Scores hole cards a and b with the table (known cards, then the first tableCount cards of the buffer)."""
+            flushBits = (suites+_SUIT_INC[a]+_SUIT_INC[b]) & _FLUSH_BITS
+            if flushBits:
+                suiteIndex = (flushBits.bit_length()-4) >> 2
+                valueMask = knownValues[suiteIndex]
+                for j in tableRange:
+                    if deck[j] // 13 == suiteIndex: valueMask |= _VALUE_BITS[deck[j]]
+                if a // 13 == suiteIndex: valueMask |= _VALUE_BITS[a]
+                if b // 13 == suiteIndex: valueMask |= _VALUE_BITS[b]
+                return _FLUSH7[valueMask]
+            histogram += _RANK_INC[a]+_RANK_INC[b]
+            rank = _HISTOGRAM7.get(histogram)
+            return rank if rank is not None else _histogramRank(histogram)
+        
+        wins = ties = losses = 0
+        shares = squaredShares = 0.0
+        varianceSum = 0.0
+        for stratumCards, stratumSize in (((), iterationCount),) if strata is None else strata:
+            for j, card in enumerate(stratumCards): #Fixed cards go first, they aren't shuffled
+                r = deck.index(card)
+                deck[j], deck[r] = deck[r], deck[j]
+            drawRange = range(len(stratumCards), drawCount)
+            stratumWins, stratumShares, stratumSquaredShares = wins, shares, squaredShares
+            for _ in range(stratumSize):
+                for j in drawRange:
+                    r = j+int(randomFloat()*(deckSize-j))
+                    deck[j], deck[r] = deck[r], deck[j]
+                histogram = knownHistogram
+                suites = knownSuites
+                for j in tableRange:
+                    histogram += _RANK_INC[deck[j]]
+                    suites += _SUIT_INC[deck[j]]
+                playerScore = score(histogram, suites, playerA, playerB)
+                bestScore = 0
+                tiedCount = 0
+                for j in otherRange:
+                    otherScore = score(histogram, suites, deck[j], deck[j+1])
+                    if otherScore > bestScore: bestScore = otherScore
+                    if otherScore == playerScore: tiedCount += 1
+                if playerScore > bestScore:
+                    wins += 1
+                elif playerScore < bestScore:
+                    losses += 1
+                else:
+                    ties += 1
+                    share = 1/(1+tiedCount)
+                    shares += share
+                    squaredShares += share*share
+            if strata is not None and stratumSize > 1: #Stratum's games count times the variance of their shares
+                stratumSum = wins-stratumWins+shares-stratumShares
+                stratumSquaredSum = wins-stratumWins+squaredShares-stratumSquaredShares
+                varianceSum += stratumSize*max(stratumSquaredSum-stratumSum*stratumSum/stratumSize, 0.0)/(stratumSize-1)
+        return EquityResult(wins, ties, losses, shares+wins, squaredShares+wins, varianceSum=None if strata is None else varianceSum)
     
-    def isWinning(self):
-        """Checks if the calculator represents a situation where the player is winning. Calculator must be assigned!"""
+    def _simulateBatched(self, iterationCount:int, seed=None, batchSize:int=20000, strata:list=None):
+        """numpy engine of _simulate(): draws batches of runouts as an array with one row per iteration (unknown table cards,
+        then 2 cards per opponent), then scores every hand of the batch with evaluate7Batch().
+        With strata (see _getStrata()), each row is given a stratum whose cards are dealt first, the other cards being shuffled after them."""
+        if numpy is None: raise PokerBotException("The numpy simulation engine requires numpy to be installed.")
+        rng = numpy.random.default_rng(seed)
+        remaining = numpy.array([card.index for card in Card.fromMask(self.deckMask)], dtype=numpy.int64)
+        tableCount = 5-len(self.tableCards)
+        drawCount = tableCount+2*self.otherPlayerCount
+        if drawCount > len(remaining): raise PokerBotException("Not enough cards in the deck for that many players!")
+        knownTable = numpy.array([card.index for card in self.tableCards], dtype=numpy.int64)
+        playerDeck = numpy.array([card.index for card in self.playerDeck], dtype=numpy.int64)
+        if strata is not None:
+            positions = {index: position for position, index in enumerate(remaining.tolist())}
+            isStratumCard = numpy.zeros((len(strata), len(remaining)), dtype=bool) #Stratum -> cards of remaining it fixes
+            for i, (stratumCards, _) in enumerate(strata):
+                isStratumCard[i, [positions[index] for index in stratumCards]] = True
+            rowStrata = numpy.repeat(numpy.arange(len(strata)), [size for _, size in strata])
+            stratumCounts = numpy.zeros(len(strata))
+            stratumSums = numpy.zeros(len(strata))
+            stratumSquaredSums = numpy.zeros(len(strata))
+        result = EquityResult()
+        done = 0
+        while done < iterationCount:
+            rows = min(batchSize, iterationCount-done)
+            if strata is None:
+                drawn = rng.permuted(numpy.tile(remaining, (rows, 1)), axis=1)[:, :drawCount]
+            else: #Random order, except that stratum cards sort first
+                keys = rng.random((rows, len(remaining)))
+                batchStrata = rowStrata[done:done+rows]
+                keys[isStratumCard[batchStrata]] = -1
+                drawn = remaining[numpy.argsort(keys, axis=1)[:, :drawCount]]
+            table = numpy.concatenate([numpy.broadcast_to(knownTable, (rows, len(knownTable))), drawn[:, :tableCount]], axis=1)
+            playerScores = evaluate7Batch(numpy.concatenate([numpy.broadcast_to(playerDeck, (rows, 2)), table], axis=1))
+            bestOtherScores = numpy.zeros(rows, dtype=playerScores.dtype)
+            tiedCounts = numpy.zeros(rows, dtype=numpy.int64) #Number of opponents with the same score as the player
+            for i in range(self.otherPlayerCount):
+                otherDeck = drawn[:, tableCount+2*i:tableCount+2*i+2]
+                otherScores = evaluate7Batch(numpy.concatenate([otherDeck, table], axis=1))
+                numpy.maximum(bestOtherScores, otherScores, out=bestOtherScores)
+                tiedCounts += otherScores == playerScores
+            won = playerScores > bestOtherScores
+            tied = playerScores == bestOtherScores
+            tiedShares = 1/(1+tiedCounts[tied])
+            if strata is not None:
+                rowShares = won.astype(float)
+                rowShares[tied] = tiedShares
+                stratumCounts += numpy.bincount(batchStrata, minlength=len(strata))
+                stratumSums += numpy.bincount(batchStrata, rowShares, len(strata))
+                stratumSquaredSums += numpy.bincount(batchStrata, rowShares*rowShares, len(strata))
+            result.add(EquityResult(int(numpy.count_nonzero(won)), int(numpy.count_nonzero(tied)), int(numpy.count_nonzero(playerScores < bestOtherScores)),
+                float(numpy.count_nonzero(won)+tiedShares.sum()), float(numpy.count_nonzero(won)+(tiedShares*tiedShares).sum())))
+            done += rows
+        if strata is not None: #Sum of each stratum's games count times the variance of their shares
+            counted = stratumCounts > 1
+            counts = stratumCounts[counted]
+            result.varianceSum = float((counts*numpy.maximum(stratumSquaredSums[counted]-stratumSums[counted]**2/counts, 0)/(counts-1)).sum())
+        return result
+    
+    def isWinning(self)->float:
+        """Checks if the calculator represents a situation where the player is winning. Calculator must be assigned!
+        Returns the player's share of the pot: 1 if winning, 1/n if tied with n-1 opponents, 0 if losing (ties aren't counted as losses)."""
         if not self.isAssigned: raise PokerBotException("Deck must be assigned to check for player win.")
-        playerScore = self.getScore(self.playerDeck+self.tableCards)
-        otherPlayerScores = [self.getScore(deck+self.tableCards) for deck in self.otherPlayerDecks]
-
+        playerScore, otherPlayerScores = self.getShowdownScores()
         bestOtherPlayerScore = max(otherPlayerScores)
-        return playerScore > bestOtherPlayerScore
-
-    def getScore(self, cards: list):
-        """Calculates the score of a 5-or-more card poker hand recursively. Scores can be compared to check which hand is winning."""
-        # print("getScore() called with:", cards) #DEBUG
-        #Split into recursion if more than 5 cards
-        if len(cards) > 5:
-            scores = []
-            for i in range(len(cards)-1):
-                scores.append(self.getScore(cards[:i]+cards[i+1:]))
-            return max(scores)
+        if playerScore > bestOtherPlayerScore: return 1
+        if playerScore < bestOtherPlayerScore: return 0
+        return 1/(1+otherPlayerScores.count(playerScore))
+    
+    def getShowdownScores(self):
+        """Scores the player's and every opponent's hand in one pass over the shared table cards. Calculator must be assigned!
+        Returns (playerScore, otherPlayerScores)."""
+        if not self.isAssigned: raise PokerBotException("Deck must be assigned to get showdown scores.")
+        hands = [[card.index for card in deck] for deck in [self.playerDeck]+self.otherPlayerDecks]
+        scores = evaluateHands([card.index for card in self.tableCards], hands)
+        return scores[0], scores[1:]
+
+    def getScore(self, cards: list)->int:
+        """Calculates the score of a 5-or-more card poker hand. Scores can be compared to check which hand is winning.
+        The score is the rank (1 to HAND_RANK_COUNT) of the best 5-card hand, see evaluate5() and evaluate7()."""
+        if metrics.enabled: metrics.increment("pokerbot_get_score_calls_total")
         if len(cards) < 5:
             raise PokerBotException("Can't get the score for a deck with less than 5 cards!")
-        
-        # print("Checking:", cards) #DEBUG
+        if len(cards) == 5:
+            return evaluate5([card.index for card in cards])
+        if len(cards) <= 7:
+            return evaluate7([card.index for card in cards])
+        return max(evaluate7(subset) for subset in itertools.combinations([card.index for card in cards], 7))
+    
+    def describeHand(self, cards: list)->str:
+        """Returns a human-readable description of the best hand made with cards (5 or more), like "Two pair, A and 7 with 3 kicker"."""
+        return describeRank(PokerCalculator.getScore(self, cards))
 
-        #Check for flushes
-        hasFlush = True
-        for card in cards:
-            if card.suite != cards[0].suite: hasFlush = False
-        
-        # if hasFlush: #DEBUG
-        #    print("Got a flush!")
-        # else:
-        #    print("No flush found!")
-        
-        #Check for n-of-a-kind
-        values = {}
-        for card in cards:
-            if card.value not in values:
-                values[card.value] = 1
-            else:
-                values[card.value] += 1
-        sameKinds = [(values[value], value) for value in values] #(count, type) tuples
-        sameKinds.sort(reverse=True, key=lambda x: x[0]*16+x[1]) #count comes first, then type matters
-        #Check for straights
-        # print("sameKinds:", sameKinds) #DEBUG
-        cards.sort(key=lambda card:card.value)
-        hasStraight = None
-        straightHigh = None
-        if len(sameKinds) != 5: hasStraight = False
-        if hasStraight is None:
-            hasStraight = (cards[4].value-cards[0].value) == 4
-            if hasStraight:
-                straightHigh = max(cards, key=lambda card:card.value).value
-            else: #Check special case of A-2-3-4-5
-                hasStraight = (cards[3].value-cards[0].value == 3) and cards[1].value == 14
-                if hasStraight:
-                    straightHigh = 5 #5-high straight
+#Range equities: many player hands against weighted opponent ranges at once (see getRangeEquities())
+HAND_COUNT = 1326 #Distinct 2-card hands
+
+def getAllHands()->list:
+    """Returns the HAND_COUNT distinct 2-card hands as (Card, Card) tuples sorted by index, the order of getRangeWeights() and getRangeEquities()."""
+    return [(Card.fromIndex(a), Card.fromIndex(b)) for a, b in itertools.combinations(range(52), 2)]
+
+def getRangeWeights(handRange)->list:
+    """Returns the weights of a hand range as a list of HAND_COUNT floats, in getAllHands() order. handRange maps hands to their weight:
+    starting hand classes ("AA", "AKs", "T9o", or "AK" for both), or pairs of cards (Card objects or strings like "As", see Card.fromString()).
+    None is the uniform range (any hand)."""
+    if handRange is None: return [1.0]*HAND_COUNT
+    allHands = getAllHands()
+    positions = {(a.index, b.index): i for i, (a, b) in enumerate(allHands)}
+    classes = [getStartingHandClass(hand) for hand in allHands]
+    weights = [0.0]*HAND_COUNT
+    for hand, weight in handRange.items():
+        if isinstance(hand, str):
+            matches = [i for i, handClass in enumerate(classes) if handClass == hand or (len(hand) == 2 and hand[0] != hand[1] and handClass[:2] == hand)]
+            if not matches: raise PokerBotException("Invalid starting hand class: {}".format(hand))
         else:
-            hasStraight = False
-        
-        # if hasStraight: #DEBUG
-        #    print("Got a straight!")
-        # else:
-        #    print("No straight found!")
-        
-        #Then get score according to poker hand hierarchy
-        
-        score = 0
-        attributes = []
-        #Straight+Flush
-        if hasFlush and hasStraight:
-            attributes.append("{}-high straight flush".format(straightHigh))
-            score += straightHigh
-        score *= 16
-        #4-kind
-        try:
-            if sameKinds[0][0] == 4:
-                attributes.append("4-of a kind with {}".format(sameKinds[0][1]))
-                score += sameKinds[0][1]
-                score *= 16
-                score += sameKinds[1][1]
-                score *= 16
+            indexes = sorted((card if isinstance(card, Card) else Card.fromString(card)).index for card in hand)
+            if len(indexes) != 2 or indexes[0] == indexes[1]: raise PokerBotException("Invalid hand: {}".format(hand))
+            matches = [positions[tuple(indexes)]]
+        for i in matches:
+            weights[i] = float(weight)
+    return weights
+
+def getRangeEquities(hands=None, opponentRanges=(None,), tableCards=(), iterationCount:int=10000, seed=None, chunkSize:int=None):
+    """Returns the winning chances (ties counting as partial wins, like EquityResult.equity) of many player hands against opponents holding hands
+    from weighted ranges (one range per opponent, see getRangeWeights()) with the given table cards, as a numpy array of floats in the order of hands
+    (2-card lists, all HAND_COUNT hands in getAllHands() order if None). Hands using a table card get NaN.
+    All hands are scored against the same iterationCount runouts: opponent hands are drawn from their ranges (redrawn if they share cards), the missing
+    table cards from the rest of the deck, then opponent hands are scored once per runout and all player hands at once (see evaluateHandsBatch()).
+    Runouts using a player hand's cards are skipped for that hand (the card removal of holding it), so each hand's equity is estimated on the runouts
+    compatible with it. Runouts are processed chunkSize at a time to bound memory use (default: about 250000 scores per chunk)."""
+    if numpy is None: raise PokerBotException("Range equities require numpy to be installed.")
+    allHands = numpy.array(list(itertools.combinations(range(52), 2)), dtype=numpy.int64)
+    playerHands = allHands if hands is None else numpy.array([[card.index for card in hand] for hand in hands], dtype=numpy.int64).reshape(-1, 2)
+    table = numpy.array([card.index for card in tableCards], dtype=numpy.int64)
+    tableMask = Card.toMask(tableCards)
+    missing = 5-len(table)
+    if not opponentRanges or missing < 0 or 2*len(opponentRanges)+missing+2 > 52-len(table):
+        raise PokerBotException("Not enough cards in the deck for that many players!")
+    cardMasks = numpy.left_shift(numpy.int64(1), numpy.arange(52, dtype=numpy.int64))
+    handMasks = cardMasks[allHands[:, 0]] | cardMasks[allHands[:, 1]]
+    playerMasks = cardMasks[playerHands[:, 0]] | cardMasks[playerHands[:, 1]]
+    probabilities = []
+    for handRange in opponentRanges:
+        weights = numpy.array(getRangeWeights(handRange))
+        weights[(handMasks & tableMask) != 0] = 0
+        if (weights < 0).any() or weights.sum() <= 0: raise PokerBotException("Opponent ranges need positive weights on hands not using table cards.")
+        probabilities.append(weights/weights.sum())
+    rng = numpy.random.default_rng(seed)
+    if chunkSize is None: chunkSize = max(1, 250000 // len(playerHands))
+    shareSums = numpy.zeros(len(playerHands))
+    counts = numpy.zeros(len(playerHands), dtype=numpy.int64)
+    done = 0
+    while done < iterationCount:
+        rows = min(chunkSize, iterationCount-done)
+        opponents = numpy.empty((0, len(probabilities)), dtype=numpy.int64) #Hand positions in allHands
+        for _ in range(1000): #Opponents can't share cards: draw more hands until there are enough compatible ones
+            drawn = numpy.stack([rng.choice(HAND_COUNT, rows, p=p) for p in probabilities], axis=1)
+            masks = handMasks[drawn]
+            opponents = numpy.concatenate([opponents, drawn[masks.sum(axis=1) == numpy.bitwise_or.reduce(masks, axis=1)]])
+            if len(opponents) >= rows: break
+        else:
+            raise PokerBotException("Opponent ranges can't be dealt together.")
+        opponents = opponents[:rows]
+        usedMasks = numpy.bitwise_or.reduce(handMasks[opponents], axis=1) | tableMask
+        keys = rng.random((rows, 52)) #Random order of the cards left, used cards sort last
+        keys[(usedMasks[:, None] >> numpy.arange(52)) & 1 == 1] = 2
+        drawnTable = numpy.argsort(keys, axis=1)[:, :missing]
+        boards = numpy.concatenate([numpy.broadcast_to(table, (rows, len(table))), drawnTable], axis=1)
+        runoutMasks = usedMasks | cardMasks[drawnTable].sum(axis=1)
+        opponentRanks = evaluateHandsBatch(boards, allHands[opponents])
+        bestRanks = opponentRanks.max(axis=1)[:, None]
+        bestCounts = (opponentRanks == bestRanks).sum(axis=1)[:, None]
+        playerRanks = evaluateHandsBatch(boards, playerHands)
+        shares = numpy.where(playerRanks > bestRanks, 1.0, numpy.where(playerRanks == bestRanks, 1/(1+bestCounts), 0.0))
+        compatible = (runoutMasks[:, None] & playerMasks) == 0
+        shareSums += (shares*compatible).sum(axis=0)
+        counts += compatible.sum(axis=0)
+        done += rows
+    with numpy.errstate(invalid="ignore"):
+        return shareSums/counts
+
+#Equity caching
+_SUITE_PERMUTATIONS = list(itertools.permutations(range(4)))
+_VALUE_LETTERS = "23456789TJQKA"
+
+def getCanonicalState(otherPlayerCount:int, playerDeck:list, tableCards:list)->tuple:
+    """Returns a key identifying a game state up to card order and suite renaming (e.g. A♠K♠ and K♥A♥ give the same key),
+    as (otherPlayerCount, playerDeck indexes, tableCards indexes) with the suite permutation giving the smallest indexes."""
+    playerIndexes = [card.index for card in playerDeck]
+    tableIndexes = [card.index for card in tableCards]
+    best = None
+    for permutation in _SUITE_PERMUTATIONS:
+        candidate = (tuple(sorted(permutation[i // 13]*13 + i % 13 for i in playerIndexes)), tuple(sorted(permutation[i // 13]*13 + i % 13 for i in tableIndexes)))
+        if best is None or candidate < best: best = candidate
+    return (otherPlayerCount,)+best
+
+def getStartingHandClass(playerDeck:list)->str:
+    """Returns the starting hand class (one of 169) of 2 hole cards, like "AA", "AKs" (suited) or "T9o" (offsuit)."""
+    high, low = sorted(playerDeck, key=lambda card: card.value, reverse=True)
+    name = _VALUE_LETTERS[high.value-2]+_VALUE_LETTERS[low.value-2]
+    if high.value == low.value: return name
+    return name+("s" if high.suite == low.suite else "o")
+
+def getStartingHandClasses()->list:
+    """Returns the 169 starting hand classes, each with an example pair of cards, as (class, playerDeck) tuples."""
+    classes = []
+    for high in range(14, 1, -1):
+        for low in range(high, 1, -1):
+            if high == low:
+                classes.append([Card("C", high), Card("H", low)])
             else:
-                raise IndexError #Do the x256 in a nonsensical-ish way
-        except IndexError:
-            score *= 256
-        #3-kind + 2-kind
-        try:
-            if sameKinds[0][0] == 3 and sameKinds[1][0] == 2:
-                attributes.append("Full house with {}+{}".format(sameKinds[0][1], sameKinds[1][1]))
-                score += sameKinds[0][1]
-                score *= 16
-                score += sameKinds[1][1]
-                score *= 16
+                classes.append([Card("C", high), Card("C", low)])
+                classes.append([Card("C", high), Card("H", low)])
+    return [(getStartingHandClass(playerDeck), playerDeck) for playerDeck in classes]
+
+def buildPreflopTable(iterationCount:int=100000, maxOtherPlayerCount:int=5, seed=None, workers=None)->dict:
+    """Simulates every starting hand class against 1 to maxOtherPlayerCount opponents. Returns a JSON-serializable table for
+    EquityCache.loadPreflopTable(): {class: [[wins, ties, losses, shares, squaredShares] for each opponent count]}."""
+    table = {}
+    for handClass, playerDeck in getStartingHandClasses():
+        table[handClass] = []
+        for otherPlayerCount in range(1, maxOtherPlayerCount+1):
+            handSeed = None if seed is None else _deriveSeed(seed, handClass, otherPlayerCount)
+            result = PokerCalculator(otherPlayerCount, playerDeck).getEquity(iterationCount, seed=handSeed, workers=workers, exactThreshold=0)
+            table[handClass].append([result.wins, result.ties, result.losses, result.shares, result.squaredShares])
+    return table
+
+class EquityCache():
+    """LRU cache of winning chance calculations, keyed by canonical game state (see getCanonicalState()) and calculation settings.
+    Results loaded from a preflop table are answered for any settings. Returned EquityResult objects are shared, don't modify them!"""
+    def __init__(self, maxSize:int=10000):
+        """Initializes an empty cache keeping at most maxSize results (not counting the preflop table)."""
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.preflopTable = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def getEquity(self, calculator, iterationCount=1000, **settings)->EquityResult:
+        """Returns calculator.getEquity(iterationCount, **settings), from the cache if the same (canonical) question was already answered."""
+        key = self.getKey(calculator, iterationCount, settings)
+        result = self.lookup(key)
+        if result is None:
+            result = calculator.getEquity(iterationCount, **settings) #Calculated without holding the lock, other threads can use the cache meanwhile
+            self.store(key, result)
+        return result
+    
+    def getKey(self, calculator, iterationCount:int, settings:dict)->tuple:
+        """Returns the cache key of a calculation: (canonical game state, iterationCount, settings)."""
+        return (getCanonicalState(calculator.otherPlayerCount, calculator.playerDeck, calculator.tableCards), iterationCount, tuple(sorted(settings.items())))
+    
+    def lookup(self, key:tuple)->EquityResult:
+        """Returns the result cached for key (or found in the preflop table), None if there isn't any. Counts a hit or a miss."""
+        with self.lock:
+            result = self.preflopTable.get(key[0])
+            if result is None:
+                result = self.entries.get(key)
+                if result is not None: self.entries.move_to_end(key)
+            if result is None:
+                self.misses += 1
             else:
-                raise IndexError
-        except IndexError:
-            score *= 256
-        #Flush
-        if hasFlush:
-            attributes.append("Flush with {}".format(cards[0].suite))
-            score += 1
-        score *= 16
-        #Straight
-        if hasStraight:
-            attributes.append("{}-high straight".format(straightHigh))
-            score += straightHigh
-        score *= 16
-        #3-kind
-        if sameKinds[0][0] == 3:
-            attributes.append("3-of a kind with {}".format(sameKinds[0][1]))
-            score += sameKinds[0][1]
-            score *= 16
-            score += sameKinds[1][1]
-            score *= 16
-            score += sameKinds[-1][1] #If it's a 3-kind+pair it'll be handled without errors
-            score *= 16
-        else:
-            score *= 4096
-        
-        
-        #2x 2-kind
+                self.hits += 1
+            return result
+    
+    def store(self, key:tuple, result:EquityResult)->None:
+        """Caches result for key, evicting the least recently used results if the cache is full."""
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+    
+    def loadPreflopTable(self, path:str)->None:
+        """Loads a preflop table made by buildPreflopTable() from a JSON file."""
+        with open(path) as file:
+            table = json.load(file)
+        preflopTable = {}
+        for handClass, playerDeck in getStartingHandClasses():
+            for otherPlayerCount, counts in enumerate(table.get(handClass, []), 1):
+                preflopTable[getCanonicalState(otherPlayerCount, playerDeck, [])] = EquityResult(*counts)
+        with self.lock:
+            self.preflopTable = preflopTable
+    
+    def clear(self)->None:
+        """Removes all cached results (but keeps the preflop table) and resets hit/miss counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def __len__(self)->int:
+        """Number of cached results, not counting the preflop table."""
+        return len(self.entries)
+
+
+class EquityTicket():
+    """Handle on a calculation requested to an EquityExecutor. result is set right away if the answer was cached. Otherwise,
+    callback(ticket, result) is called from a compute thread once the calculation is done, unless the ticket was cancelled."""
+    def __init__(self, executor, callback):
+        """Initializes a pending ticket of executor."""
+        self.executor = executor
+        self.callback = callback
+        self.result = None
+        self.cancelled = False
+        self.job = None
+    
+    def cancel(self)->None:
+        """Cancels the ticket: its callback won't be called. The calculation itself stops once all of its tickets are cancelled."""
+        self.executor.cancel(self)
+
+class EquityJob():
+    """Calculation running (or waiting to run) on an EquityExecutor, shared by all the tickets asking the same question."""
+    def __init__(self, key:tuple, calculator, iterationCount:int, settings:dict):
+        """Initializes job for a calculation of calculator (which must be a copy owned by the job)."""
+        self.key = key
+        self.calculator = calculator
+        self.iterationCount = iterationCount
+        self.settings = settings
+        self.tickets = []
+        self.cancelEvent = threading.Event()
+        self.future = None
+
+class EquityExecutor():
+    """Runs winning chance calculations on a dedicated thread pool, so they don't block the threads handling user requests.
+    Requests for the same canonical question (see EquityCache.getKey()) share one job, results are stored in the cache."""
+    def __init__(self, cache:EquityCache, workers:int=2, errorHandler=None):
+        """Initializes executor with its cache and number of compute threads. errorHandler(exception) is called for failed calculations and callbacks."""
+        self.cache = cache
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="equity")
+        self.jobs = {} #Cache key -> EquityJob
+        self.lock = threading.Lock()
+        self.errorHandler = errorHandler
+    
+    def submit(self, calculator, iterationCount:int, callback, **settings)->EquityTicket:
+        """Requests calculator.getEquity(iterationCount, **settings), see EquityTicket. The calculator isn't used after this returns."""
+        ticket = EquityTicket(self, callback)
+        key = self.cache.getKey(calculator, iterationCount, settings)
+        ticket.result = self.cache.lookup(key)
+        if ticket.result is not None: return ticket
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                job = self.jobs[key] = EquityJob(key, calculator.copy(), iterationCount, settings)
+                job.future = self.pool.submit(self._run, job)
+            job.tickets.append(ticket)
+            ticket.job = job
+        return ticket
+    
+    def cancel(self, ticket:EquityTicket)->None:
+        """Cancels ticket, and its job if no other ticket is waiting for it."""
+        with self.lock:
+            ticket.cancelled = True
+            job = ticket.job
+            if job is None or ticket not in job.tickets: return
+            job.tickets.remove(ticket)
+            if not job.tickets:
+                job.cancelEvent.set()
+                job.future.cancel()
+                if self.jobs.get(job.key) is job: del self.jobs[job.key]
+    
+    def _run(self, job:EquityJob)->None:
+        """Compute thread task: runs job, caches its result and calls back its (non-cancelled) tickets."""
         try:
-            if sameKinds[0][0] == 2 and sameKinds[1][0] == 2:
-                maxVal = max(sameKinds[0][1], sameKinds[1][1])
-                minVal = min(sameKinds[0][1], sameKinds[1][1])
-                kicker = sameKinds[2][1]
-                attributes.append("{}-high {}-low double pair".format(maxVal, minVal))
-                #score += maxVal*4096 + minVal*256 + kicker*16
-                score += maxVal
-                score *= 16
-                score += minVal
-                score *= 16
-                score += kicker
-                score *= 16
-            else:
-                raise IndexError
-        except IndexError:
-            score *= 4096
-        #2-kind
-        if sameKinds[0][0] == 2:
-            attributes.append("{}-high pair".format(sameKinds[0][1]))
-            score += sameKinds[0][1]
-        #Take raw card values into account (high cards)
-        cards.sort(reverse=True, key=lambda card: card.value) #Sort from highest to lowest, then store individual card values
-        for card in cards:
-            score *= 16
-            score += card.value
-        
-        # print(attributes) #DEBUG
-        return score
+            result = job.calculator.getEquity(job.iterationCount, cancelEvent=job.cancelEvent, **job.settings)
+        except Exception as e:
+            result = None
+            self._handleError(e)
+        with self.lock:
+            if self.jobs.get(job.key) is job: del self.jobs[job.key]
+            tickets, job.tickets = job.tickets, []
+        if result is None or job.cancelEvent.is_set(): return #Cancelled results may be partial, don't cache them
+        self.cache.store(job.key, result)
+        for ticket in tickets:
+            ticket.result = result
+            try:
+                ticket.callback(ticket, result)
+            except Exception as e:
+                self._handleError(e)
+    
+    def _handleError(self, e:Exception)->None:
+        """Gives e to the error handler, if any."""
+        if self.errorHandler is not None: self.errorHandler(e)
+    
+    def shutdown(self)->None:
+        """Cancels pending jobs and stops the compute threads."""
+        self.pool.shutdown(cancel_futures=True)
+
+
+#Batch equity (headless, see runBatchEquity())
+def parseGameState(text:str, defaults:dict)->tuple:
+    """Parses a JSON game state line, like {"hand": ["As", "Kh"], "board": ["2d", "Jc", "Qd"], "opponents": 3}, with optional "iterations",
+    "exact" (true to enumerate every outcome whatever their number, false to always simulate), "seed" and "id" fields.
+    Missing fields are taken from defaults. Returns (calculator, iterationCount, getEquity() settings, id)."""
+    state = json.loads(text)
+    calculator = PokerCalculator(int(state["opponents"]), [Card.fromString(card) for card in state["hand"]], [Card.fromString(card) for card in state.get("board", [])])
+    if len(calculator.playerDeck) != 2 or len(calculator.tableCards) > 5:
+        raise PokerBotException("A game state needs 2 cards in hand and at most 5 on the board")
+    settings = {"seed": state.get("seed", defaults.get("seed"))}
+    if "exact" in state: settings["exactThreshold"] = math.inf if state["exact"] else 0
+    return calculator, int(state.get("iterations", defaults["iterations"])), settings, state.get("id")
+
+def calculateGameStates(lines:list, defaults:dict)->list:
+    """Process pool task of runBatchEquity(): returns the JSON result line of each (line number, game state line) of lines.
+    States without a seed get one derived from defaults["seed"] and their line number (if given), so results don't depend on the worker count."""
+    outputs = []
+    for lineNumber, text in lines:
+        output = {"line": lineNumber}
+        try:
+            calculator, iterationCount, settings, stateId = parseGameState(text, defaults)
+            if stateId is not None: output["id"] = stateId
+            if settings["seed"] is None and defaults.get("seed") is not None: settings["seed"] = _deriveSeed(defaults["seed"], "line", lineNumber)
+            result = calculator.getEquity(iterationCount, **settings)
+            output.update(equity=result.equity, wins=result.wins, ties=result.ties, losses=result.losses, total=result.total, standardError=result.standardError, exact=result.isExact)
+        except Exception as e:
+            output["error"] = repr(e)
+        outputs.append(json.dumps(output))
+    return outputs
 
+def runBatchEquity(inputFile, outputFile, workers:int=1, iterationCount:int=10000, seed=None, chunkSize:int=64, progressFile=sys.stderr, progressInterval:float=5)->int:
+    """Calculates the winning chance of each game state line of inputFile (see parseGameState()) and writes one JSON result line per state
+    to outputFile, in input order (errors are written as {"line": ..., "error": ...}). Returns the number of states handled.
+    Lines are read and sent to workers processes (see getProcessPool()) by chunks of chunkSize, with at most 2 chunks per worker in flight,
+    so memory use doesn't depend on the input size. Progress and throughput are written to progressFile every progressInterval seconds."""
+    defaults = {"iterations": iterationCount, "seed": seed}
+    pool = getProcessPool(workers) if workers > 1 else None
+    lines = ((lineNumber, text) for lineNumber, text in enumerate(inputFile, 1) if text.strip())
+    pending = collections.deque() #Futures (or results without a pool) of the chunks in flight, in input order
+    stateCount = 0
+    startTime = lastProgress = time.monotonic()
+    def writeProgress(final:bool=False)->None:
+        duration = time.monotonic()-startTime
+        progressFile.write("{} {} game states in {:.1f} s, {:.1f} states/s\n".format("Done:" if final else "Progress:", stateCount, duration, stateCount/duration if duration else 0))
+        progressFile.flush()
+    while True:
+        chunk = list(itertools.islice(lines, chunkSize))
+        if chunk:
+            pending.append(pool.submit(calculateGameStates, chunk, defaults) if pool is not None else calculateGameStates(chunk, defaults))
+        while pending and (not chunk or len(pending) > 2*max(workers, 1) or pool is None): #Write finished chunks once the window is full, or at the end
+            outputs = pending.popleft()
+            if pool is not None: outputs = outputs.result()
+            outputFile.write("\n".join(outputs)+"\n")
+            stateCount += len(outputs)
+            if progressFile is not None and time.monotonic()-lastProgress >= progressInterval:
+                writeProgress()
+                lastProgress = time.monotonic()
+        if not chunk: break
+    outputFile.flush()
+    if progressFile is not None: writeProgress(final=True)
+    return stateCount
 
 if __name__ == "__main__":
     import sys
+    defaultPreflopTablePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "preflop_table.json")
+    if len(sys.argv) in (2,3,4) and sys.argv[1] == "build-preflop-table":
+        iterationCount = int(sys.argv[3]) if len(sys.argv) == 4 else 100000
+        path = sys.argv[2] if len(sys.argv) >= 3 else defaultPreflopTablePath
+        print("Building preflop table with {} iterations per hand, this takes a while...".format(iterationCount))
+        with open(path, "w") as file:
+            json.dump(buildPreflopTable(iterationCount, seed=0), file, separators=(",", ":"))
+        exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == "equity":
+        #Headless batch mode: equity [FILE] [--workers N] [--iterations N] [--seed N], reads stdin if FILE is missing or -
+        settings = {"--workers": 1, "--iterations": 10000, "--seed": None}
+        for option in settings:
+            if option in sys.argv[:-1]:
+                position = sys.argv.index(option)
+                settings[option] = int(sys.argv[position+1])
+                del sys.argv[position:position+2]
+        path = sys.argv[2] if len(sys.argv) >= 3 else "-"
+        inputFile = sys.stdin if path == "-" else open(path)
+        runBatchEquity(inputFile, sys.stdout, settings["--workers"], settings["--iterations"], settings["--seed"])
+        exit(0)
+    webhookUrl = None #Webhook mode: --webhook URL [--listen HOST:PORT], the secret token is read from POKERBOT_WEBHOOK_SECRET if set
+    listen = "0.0.0.0:8443"
+    metricsPath = None #--metrics FILE: Prometheus text file, written every 15 s
+    adminIds = () #--admins ID,ID,...: users allowed to use /stats
+    sessionStorePath = None #--sessions FILE: SQLite file keeping idle sessions, and open ones across restarts
+    for option in ("--webhook", "--listen", "--metrics", "--admins", "--sessions"):
+        if option in sys.argv[:-1]:
+            position = sys.argv.index(option)
+            if option == "--webhook": webhookUrl = sys.argv[position+1]
+            elif option == "--listen": listen = sys.argv[position+1]
+            elif option == "--metrics": metricsPath = sys.argv[position+1]
+            elif option == "--sessions": sessionStorePath = sys.argv[position+1]
+            else: adminIds = [int(userId) for userId in sys.argv[position+1].split(",")]
+            del sys.argv[position:position+2]
     if len(sys.argv) not in (2,3):
-       print("Syntax: python \"{}\" <BOT_TOKEN> [DEBUG_CHANNEL_ID].".format(sys.argv[0]))
+       print("Syntax: python \"{}\" <BOT_TOKEN> [DEBUG_CHANNEL_ID] [--webhook URL [--listen HOST:PORT]] [--metrics FILE] [--admins ID,...] [--sessions FILE]".format(sys.argv[0]))
+       print("        python \"{}\" build-preflop-table [FILE] [ITERATIONS]".format(sys.argv[0]))
+       print("        python \"{}\" equity [FILE] [--workers N] [--iterations N] [--seed N]".format(sys.argv[0]))
        exit(1) #Exit with error
     token = sys.argv[1]
     try:
         channelId = sys.argv[2]
     except IndexError:
         channelId = None
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
     if channelId is None:
         print("""Note: Pokerbot started without a debug channel.
 Add the debug channel ID after your API token as an argument to get all exceptions and debug messages sent there.
 NOTE: the bot has to be an admin of the given group (otherwise it's not allowed to send messages without prior interactions)""")
-    pokerbot = PokerBot(token, channelId)
-    pokerbot.start()
\ No newline at end of file
+    pokerbot = PokerBot(token, channelId, defaultPreflopTablePath if os.path.exists(defaultPreflopTablePath) else None, adminIds=adminIds, metricsPath=metricsPath, sessionStorePath=sessionStorePath)
+    host, port = listen.rsplit(":", 1)
+    pokerbot.start(webhookUrl, host, int(port), os.environ.get("POKERBOT_WEBHOOK_SECRET"))
\ No newline at end of file
@@ -0,0 +1,206 @@
+#This file runs benchmarks for the pokerbot library
+#Usage: python pokerbot_bench.py [--quick] [--output FILE] [--compare BASELINE_FILE] [--threshold 0.25]
+#Results are printed and can be saved as JSON, then compared against in later runs: slowdowns above the threshold are flagged (exit code 1)
+
+import pokerbot as pb
+import pokerbot_test
+import time
+import tracemalloc
+import random
+import json
+import sys
+import platform
+import argparse
+import subprocess
+import os
+
+def makeCalculator()->pb.PokerCalculator:
+    """Flop with 3 opponents: too many outcomes to enumerate, so every engine has to simulate."""
+    return pb.PokerCalculator(3, [pb.Card("S",14), pb.Card("H",13)], [pb.Card("D",2), pb.Card("C",11), pb.Card("D",12)])
+
+def measurePeakBytes(func)->int:
+    """Returns the peak memory allocated while running func(), above the memory allocated before running it."""
+    tracemalloc.start()
+    startMemory = tracemalloc.get_traced_memory()[0]
+    func()
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peakMemory-startMemory
+
+def measureSeconds(func, repeats:int=3)->float:
+    """Returns the shortest duration of repeats runs of func(), the least noisy estimate of its cost."""
+    durations = []
+    for _ in range(repeats):
+        startTime = time.perf_counter()
+        func()
+        durations.append(time.perf_counter()-startTime)
+    return min(durations)
+
+def benchmarkSampler(iterationCount:int=20000, engines=("reference", "inplace"))->dict:
+    """Measures time per iteration and memory allocated by each iteration for each simulation engine. Allocation per iteration is
+    the peak memory of a 1-iteration simulation minus the one of a 0-iteration simulation (which only does the setup). Returns {engine: measures}."""
+    results = {}
+    for engine in engines:
+        calculator = makeCalculator()
+        calculator._simulate(100, engine, seed=0) #Warm up lazy tables and buffers
+        startTime = time.perf_counter()
+        calculator._simulate(iterationCount, engine, seed=1)
+        duration = time.perf_counter()-startTime
+        setupBytes = min(measurePeakBytes(lambda: calculator._simulate(0, engine, seed=2)) for _ in range(5))
+        iterationBytes = min(measurePeakBytes(lambda: calculator._simulate(1, engine, seed=2)) for _ in range(5))
+        results[engine] = {"microsecondsPerIteration": duration/iterationCount*1e6, "bytesPerIteration": max(iterationBytes-setupBytes, 0)}
+    return results
+
+def benchmarkScoring(handCount:int=20000)->dict:
+    """Measures 5-card and 7-card scoring throughput on the same random hands (seed 0), through getScore() and the index-based evaluators."""
+    rng = random.Random(0)
+    deck = pb.Card.getDeck(None)
+    results = {}
+    for size, evaluate in ((5, pb.evaluate5), (7, pb.evaluate7)):
+        hands = [rng.sample(deck, size) for _ in range(handCount)]
+        indexHands = [[card.index for card in hand] for hand in hands]
+        getScore = pb.PokerCalculator.getScore
+        scoreDuration = measureSeconds(lambda: [getScore(None, hand) for hand in hands])
+        evaluateDuration = measureSeconds(lambda: [evaluate(hand) for hand in indexHands])
+        results["{}cards".format(size)] = {"getScorePerSecond": handCount/scoreDuration, "evaluationsPerSecond": handCount/evaluateDuration}
+    return results
+
+def benchmarkWinningChance(iterationCount:int=10000, repeats:int=3)->dict:
+    """Measures getWinningChance() latency (seeded, default engine and settings) for 1 to 5 opponents at each stage of a game.
+    States are drawn once from seed 0, so every run measures the same games. Small states are enumerated exactly, like in the bot."""
+    rng = random.Random(0)
+    results = {}
+    for opponentCount in range(1, 6):
+        cards = rng.sample(pb.Card.getDeck(None), 7)
+        for stage, tableCount in (("preflop", 0), ("flop", 3), ("turn", 4), ("river", 5)):
+            calculator = pb.PokerCalculator(opponentCount, cards[:2], cards[2:2+tableCount])
+            calculator.getWinningChance(100, seed=0) #Warm up lazy tables
+            duration = measureSeconds(lambda: calculator.getWinningChance(iterationCount, seed=0), repeats)
+            results["{}opponents-{}".format(opponentCount, stage)] = {"milliseconds": duration*1000}
+    return results
+
+def benchmarkVarianceReduction(iterationCount:int=20000, targetError:float=0.005, seedCount:int=5)->dict:
+    """Compares plain and stratified simulations (default engine, seed 0) of the same 1-opponent game at each stage: effective sample size
+    per game and effective samples per second (see pb.EquityResult.effectiveSampleSize), and the mean number of games adaptive simulations
+    (like the bot's, see pb.Session) need to reach targetError over seedCount seeds. States are drawn from seed 0."""
+    cards = random.Random(0).sample(pb.Card.getDeck(None), 7)
+    results = {}
+    for stage, tableCount in (("preflop", 0), ("flop", 3), ("turn", 4)):
+        calculator = pb.PokerCalculator(1, cards[:2], cards[2:2+tableCount])
+        for name, stratify in (("plain", False), ("stratified", True)):
+            calculator.getEquity(100, seed=0, exactThreshold=0, stratify=stratify) #Warm up lazy tables
+            startTime = time.perf_counter()
+            result = calculator.getEquity(iterationCount, seed=0, exactThreshold=0, stratify=stratify)
+            duration = time.perf_counter()-startTime
+            gamesToTarget = sum(calculator.getEquity(pb.Session.maxIterations, seed=seed, exactThreshold=0, targetError=targetError, stratify=stratify).total for seed in range(seedCount))/seedCount
+            results["{}-{}".format(stage, name)] = {"standardErrorPermille": result.standardError*1000, "effectiveSamplesPerGame": result.effectiveSampleSize/result.total,
+                "effectiveSamplesPerSecond": result.effectiveSampleSize/duration, "gamesToTarget": gamesToTarget}
+    return results
+
+def benchmarkRangeEquity(iterationCount:int=2000, loopedHandCount:int=20)->dict:
+    """Measures getRangeEquities() for all 1326 hands against 2 random opponents on a flop (seed 0), against getWinningChance() called
+    for each hand with the same iteration count (timed on loopedHandCount hands, extrapolated to all of them)."""
+    if pb.numpy is None: return {}
+    table = [pb.Card("D",2), pb.Card("C",11), pb.Card("D",12)]
+    pb.getRangeEquities(None, [None, None], table, 10, seed=0) #Warm up lazy tables
+    bulkDuration = measureSeconds(lambda: pb.getRangeEquities(None, [None, None], table, iterationCount, seed=0), 1)
+    hands = [hand for hand in pb.getAllHands() if not set(hand) & set(table)][:loopedHandCount]
+    loopDuration = measureSeconds(lambda: [pb.PokerCalculator(2, list(hand), table).getWinningChance(iterationCount, seed=0, exactThreshold=0) for hand in hands], 1)
+    return {"allHands": {"bulkMilliseconds": bulkDuration*1000, "loopedMilliseconds": loopDuration/len(hands)*pb.HAND_COUNT*1000, "handsPerSecond": pb.HAND_COUNT/bulkDuration}}
+
+class InstantEquityExecutor():
+    """Stands in for pb.EquityExecutor in the callback benchmark: answers right away with a fixed result, so only the session's own work is measured."""
+    result = pb.EquityResult(500, 10, 490, 505, 505)
+
+    def submit(self, calculator, iterationCount, callback, **settings):
+        ticket = pb.EquityTicket(self, callback)
+        ticket.result = self.result
+        return ticket
+
+    def cancel(self, ticket):
+        ticket.cancelled = True
+
+def benchmarkCallbacks(gameCount:int=200)->dict:
+    """Measures end-to-end Session.callbackHandler throughput with an in-memory bot (see pokerbot_test.FakeBot): each game picks the opponent count
+    and 2 cards, reveals the 5 table cards, then restarts (21 callbacks). Winning chances are answered instantly (see InstantEquityExecutor)."""
+    script = ["setPlayerCount-1", "setSuite-S", "setValue-14", "setSuite-H", "setValue-13"]
+    for value in range(2, 7):
+        script += ["mainMenuOnce-reveal", "setSuite-D", "setValue-"+str(value)]
+    script.append("mainMenuOnce-retry")
+    def run()->None:
+        session, parent = pokerbot_test.makeSession()
+        parent.equityExecutor = InstantEquityExecutor()
+        for _ in range(gameCount):
+            pokerbot_test.replayCallbacks(session, script)
+    duration = measureSeconds(run)
+    callbackCount = gameCount*len(script)
+    return {"session": {"callbacksPerSecond": callbackCount/duration, "microsecondsPerCallback": duration/callbackCount*1e6}}
+
+def benchmarkStartup(repeats:int=3)->dict:
+    """Measures the startup time of fresh Python processes: importing the calculator alone (what simulation workers and scripts pay),
+    importing it with the Telegram bot stack, and running the batch equity CLI on empty input."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    commands = {
+        "calculator": [sys.executable, "-c", "import pokerbot"],
+        "calculatorWithBot": [sys.executable, "-c", "import pokerbot; pokerbot._importTelebot()"],
+        "batchCli": [sys.executable, "pokerbot.py", "equity"],
+    }
+    results = {}
+    for name, command in commands.items():
+        duration = measureSeconds(lambda: subprocess.run(command, input="", capture_output=True, text=True, cwd=directory, check=True), repeats)
+        results[name] = {"milliseconds": duration*1000}
+    return results
+
+BENCHMARKS = [benchmarkScoring, benchmarkWinningChance, benchmarkCallbacks, benchmarkSampler, benchmarkVarianceReduction, benchmarkRangeEquity, benchmarkStartup]
+QUICK_SETTINGS = {"benchmarkScoring": {"handCount": 2000}, "benchmarkWinningChance": {"iterationCount": 2000, "repeats": 1}, "benchmarkCallbacks": {"gameCount": 20}, "benchmarkSampler": {"iterationCount": 2000}, "benchmarkVarianceReduction": {"iterationCount": 5000, "seedCount": 2}, "benchmarkRangeEquity": {"iterationCount": 500, "loopedHandCount": 5}, "benchmarkStartup": {"repeats": 1}}
+
+def runAllBenchmarks(quick:bool=False)->dict:
+    """Runs every benchmark (with smaller sizes if quick), printing results as they come. Returns {"environment": ..., "results": {benchmark: {case: measures}}}."""
+    pb.metrics.enabled = False #Measure the code itself, not the instrumentation
+    report = {"environment": {"python": platform.python_version(), "numpy": pb.numpy.__version__ if pb.numpy is not None else None, "quick": quick}, "results": {}}
+    for func in BENCHMARKS:
+        print(func.__name__)
+        results = func(**(QUICK_SETTINGS[func.__name__] if quick else {}))
+        for name, measures in results.items():
+            print("  {:<20} {}".format(name, ", ".join("{}={:.1f}".format(key, value) for key, value in measures.items())))
+        report["results"][func.__name__] = results
+    return report
+
+HIGHER_IS_BETTER = ("effectiveSamplesPerGame",) #Measures better when higher, besides throughputs
+
+def isHigherBetter(measure:str)->bool:
+    """Throughput measures (...PerSecond) and HIGHER_IS_BETTER ones are better when higher, durations and sizes when lower."""
+    return measure.endswith("PerSecond") or measure in HIGHER_IS_BETTER
+
+def compareResults(baseline:dict, current:dict, threshold:float=0.25)->list:
+    """Returns the slowdowns of report current against report baseline, as (benchmark, case, measure, baseline value, current value) tuples:
+    measures more than threshold (as a fraction) worse than in the baseline. Measures missing from either report are ignored."""
+    slowdowns = []
+    for benchmark, cases in current["results"].items():
+        for case, measures in cases.items():
+            for measure, value in measures.items():
+                baselineValue = baseline["results"].get(benchmark, {}).get(case, {}).get(measure)
+                if baselineValue is None or baselineValue <= 0: continue
+                ratio = baselineValue/value if isHigherBetter(measure) else value/baselineValue
+                if value > 0 and ratio > 1+threshold:
+                    slowdowns.append((benchmark, case, measure, baselineValue, value))
+    return slowdowns
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the pokerbot benchmarks.")
+    parser.add_argument("--quick", action="store_true", help="smaller benchmark sizes, for a quick check")
+    parser.add_argument("--output", help="saves the results as JSON to this file")
+    parser.add_argument("--compare", help="flags slowdowns against the results saved in this file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="slowdown flagged above this fraction (default: 0.25)")
+    arguments = parser.parse_args()
+    report = runAllBenchmarks(arguments.quick)
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if arguments.compare is not None:
+        with open(arguments.compare) as file:
+            slowdowns = compareResults(json.load(file), report, arguments.threshold)
+        for benchmark, case, measure, baselineValue, value in slowdowns:
+            print("SLOWDOWN {}/{} {}: {:.1f} -> {:.1f}".format(benchmark, case, measure, baselineValue, value))
+        print("{} slowdown(s) above {:.0%}".format(len(slowdowns), arguments.threshold))
+        if slowdowns: sys.exit(1)
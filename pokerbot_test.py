@@ -1,15 +1,30 @@
 #This file runs all tests for the pokerbot library
 
 import pokerbot as pb
+import pickle
+import math
+import itertools
+import random
+import time
+import os
+import json
+import tempfile
+import threading
+import concurrent.futures
+import types
+import http.client
+import io
+import sys
+import subprocess
 
 #TODO implement tests for all math functions (that is, non-UI functions that return something) in the program
-#Tests working: card comparisons, poker hand scores, PokerCalculator.assignRandomCards
+#Tests working: card comparisons, card encoding, poker hand scores, hand ranks, 7-card scores, PokerCalculator.assignRandomCards, batched simulation engine, seeded/parallel simulations, exact equity, adaptive simulations, stratified simulations, range equities, equity cache, inplace engine, equity executor, session registry, session store, callback dispatcher, session flow, webhook server, log handler, metrics, keyboard cache, batch equity, benchmark comparison, import-light calculator
 #Tests to do: none yet
 
 def testCardComparison():
     try:
         deck = pb.Card.getDeck(None) #Get 52 card deck
-        deck2 = pb.Card.getDeck(None) #Same deck but different objects
+        deck2 = pb.Card.getDeck(None) #Same deck, different list (cards themselves are interned)
         for i in range(len(deck)): #Check that they're all equal to eachother
             assert deck[i] == deck2[i]
             for j in range(i):
@@ -18,6 +33,28 @@ def testCardComparison():
     except AssertionError:
         return False #At least one assertion failed
 
+def testCardEncoding():
+    try:
+        deck = pb.Card.getDeck(None)
+        assert len(deck) == 52 and len(set(deck)) == 52
+        for i, card in enumerate(deck):
+            assert card.index == i and card.mask == 1 << i
+            assert pb.Card(card.suite, card.value) is card #Cards are interned
+            assert pb.Card.fromIndex(i) is card
+        hand = [pb.Card("S", 14), pb.Card("C", 2), pb.Card("D", 10)]
+        mask = pb.Card.toMask(hand)
+        assert mask.bit_count() == 3
+        assert set(pb.Card.fromMask(mask)) == set(hand)
+        assert pickle.loads(pickle.dumps(hand)) == hand
+        try:
+            pb.Card("X", 3)
+            return False #Invalid cards must be rejected
+        except pb.PokerBotException:
+            pass
+        return True
+    except AssertionError:
+        return False
+
 def testPokerScores():
     pokerHands = [
         [pb.Card("H", 14), pb.Card("H", 13), pb.Card("H", 12), pb.Card("H", 11), pb.Card("H", 10)], #High Straight Flush
@@ -44,6 +81,39 @@ def testPokerScores():
     decreasing = [scores[i+1] < scores[i] for i in range(len(scores)-1)]
     return all(decreasing)
 
+def testHandRanks():
+    try:
+        wheel = [pb.Card("S",14), pb.Card("H",2), pb.Card("S",3), pb.Card("C",4), pb.Card("D",5)] #A-2-3-4-5 straight
+        sixHigh = [pb.Card("S",2), pb.Card("H",3), pb.Card("S",4), pb.Card("C",5), pb.Card("D",6)]
+        trips = [pb.Card("S",14), pb.Card("H",14), pb.Card("D",14), pb.Card("H",13), pb.Card("C",12)]
+        assert pb.PokerCalculator.getScore(None, trips) < pb.PokerCalculator.getScore(None, wheel) < pb.PokerCalculator.getScore(None, sixHigh)
+        #Every 5-card hand of the deck is ranked, and there are exactly HAND_RANK_COUNT distinct ranks
+        ranks = set()
+        for hand in itertools.combinations(range(52), 5):
+            ranks.add(pb.evaluate5(hand))
+        assert ranks == set(range(1, pb.HAND_RANK_COUNT+1))
+        assert pb.PokerCalculator.describeHand(None, wheel) == "Straight, 5 high"
+        assert pb.PokerCalculator.describeHand(None, trips) == "Three of a kind, A with K-Q"
+        assert pb.describeRank(pb.HAND_RANK_COUNT) == "Straight flush, A high"
+        return True
+    except AssertionError:
+        return False
+
+def testSevenCardScores():
+    #Compares the direct evaluator with a brute-force oracle (best of all 5-card subsets)
+    rng = random.Random(7)
+    for _ in range(3000):
+        cards = rng.sample(range(52), 9)
+        oracle = max(pb.evaluate5(subset) for subset in itertools.combinations(cards[:7], 5))
+        if pb.evaluate7(cards[:7]) != oracle: return False
+        if pb.evaluate7(cards[:6]) != max(pb.evaluate5(subset) for subset in itertools.combinations(cards[:6], 5)): return False
+        if pb.evaluateHands(cards[:5], [cards[5:7], cards[7:9]]) != [oracle, pb.evaluate7(cards[:5]+cards[7:9])]: return False
+    #Flushes with 6 or 7 cards of a suite, and a straight flush hidden among them
+    cards = [pb.Card("H", value) for value in [2, 3, 4, 5, 6, 9, 13]]
+    if pb.PokerCalculator.describeHand(None, cards) != "Straight flush, 6 high": return False
+    cards = [pb.Card("H", value) for value in [2, 3, 4, 5, 8, 9, 13]]
+    return pb.PokerCalculator.describeHand(None, cards) == "Flush, K-9-8-5-4"
+
 def testCalculatorAssignment():
 
     hasSameElements = lambda l1, l2: len(l1) == len(l2) and all([element in l2 for element in l1]) and all([element in l1 for element in l2])
@@ -52,10 +122,512 @@ def testCalculatorAssignment():
     copy = calc.copy()
     copy.assignRandomCards()
 
-    return (calc is not copy) and (calc.otherPlayerCount == copy.otherPlayerCount) and hasSameElements(calc.playerDeck, copy.playerDeck) and not calc.tableCards and len(copy.tableCards) == 5 and not calc.otherPlayerDecks and len(copy.otherPlayerDecks) == 2 and len(copy.otherPlayerDecks[0]) == 2 
+    return (calc is not copy) and (calc.otherPlayerCount == copy.otherPlayerCount) and hasSameElements(calc.playerDeck, copy.playerDeck) and not calc.tableCards and len(copy.tableCards) == 5 and not calc.otherPlayerDecks and len(copy.otherPlayerDecks) == 2 and len(copy.otherPlayerDecks[0]) == 2 and copy.deckMask.bit_count() == 52-2-5-4
+
+def testBatchedEngine():
+    if pb.numpy is None: return True #Batched engine is only available with numpy
+    rng = random.Random(4)
+    rows = [rng.sample(range(52), 7) for _ in range(5000)]
+    ranks = pb.evaluate7Batch(pb.numpy.array(rows))
+    if [int(rank) for rank in ranks] != [pb.evaluate7(row) for row in rows]: return False
+    #Both engines must agree statistically (within 4 standard errors)
+    for otherPlayerCount, playerDeck, tableCards in [(1, [pb.Card("S",14), pb.Card("H",13)], []), (3, [pb.Card("D",9), pb.Card("D",10)], [pb.Card("D",2), pb.Card("C",11), pb.Card("D",12)])]:
+        calc = pb.PokerCalculator(otherPlayerCount, playerDeck, tableCards)
+        batched = calc.getWinningChance(40000, engine="numpy")
+        reference = calc.getWinningChance(4000, engine="reference")
+        standardError = (batched*(1-batched)/40000 + reference*(1-reference)/4000)**0.5
+        if abs(batched-reference) > 4*standardError: return False
+    return True
+
+def testSeededSimulation():
+    calc = pb.PokerCalculator(2, [pb.Card("S",12), pb.Card("H",12)], [pb.Card("C",3), pb.Card("D",8), pb.Card("S",13)])
+    for engine in ["reference"] if pb.numpy is None else ["reference", "numpy"]:
+        if calc.getWinningChance(2000, engine=engine, seed=42) != calc.getWinningChance(2000, engine=engine, seed=42): return False
+    try:
+        parallel = calc.getWinningChance(20000, seed=42, workers=2)
+        if parallel != calc.getWinningChance(20000, seed=42, workers=2): return False #Same (seed, workers) gives the same result
+        if pb.getProcessPool(2) is not pb.getProcessPool(2): return False #Pool is reused
+        single = calc.getWinningChance(20000, seed=7)
+        return abs(parallel-single) < 4*(2*single*(1-single)/20000)**0.5
+    finally:
+        pb.shutdownProcessPool()
+
+def testExactEquity():
+    #Royal flush on the table: every outcome is a 3-way split
+    calc = pb.PokerCalculator(2, [pb.Card("S",2), pb.Card("H",3)], [pb.Card("D",value) for value in range(10, 15)])
+    result = calc.getEquity()
+    if not result.isExact or result.ties != result.total or result.total != calc.estimateEnumerationSize() or abs(result.equity-1/3) > 1e-9: return False
+    #Heads-up on the turn: exact result must match a large simulation
+    calc = pb.PokerCalculator(1, [pb.Card("S",14), pb.Card("H",13)], [pb.Card("D",2), pb.Card("C",11), pb.Card("D",12), pb.Card("H",7)])
+    exact = calc.getEquity()
+    if not exact.isExact or exact.total != 46*45*44//2 or exact.wins+exact.ties+exact.losses != exact.total: return False
+    simulated = calc.getEquity(20000, seed=3, exactThreshold=0)
+    if simulated.isExact or abs(simulated.equity-exact.equity) > 4*(exact.equity*(1-exact.equity)/20000)**0.5: return False
+    #Ties count as a share of the pot, not as losses
+    copy = pb.PokerCalculator(2, [pb.Card("S",2), pb.Card("H",3)], [pb.Card("D",value) for value in range(10, 15)]).copy()
+    copy.assignRandomCards()
+    return copy.isWinning() == 1/3
+
+def testAdaptiveSimulation():
+    calc = pb.PokerCalculator(2, [pb.Card("S",14), pb.Card("H",13)])
+    result = calc.getEquity(10**6, engine="reference", seed=5, targetError=0.01, batchSize=500)
+    if result.standardError > 0.01 or result.iterations >= 10**6 or result.iterations % 500: return False
+    low, high = result.confidenceInterval()
+    if not low < result.equity < high or abs((high-low)/2-1.96*result.standardError) > 1e-9: return False
+    if result.iterations != calc.getEquity(10**6, engine="reference", seed=5, targetError=0.01, batchSize=500).iterations: return False
+    #With the default engine and batches, a clear-cut spot (royal flush) stops before a close one
+    clearCut = pb.PokerCalculator(1, [pb.Card("S",14), pb.Card("S",13)], [pb.Card("S",12), pb.Card("S",11), pb.Card("S",10)]).getEquity(200000, seed=0, exactThreshold=0, targetError=0.005)
+    close = pb.PokerCalculator(1, [pb.Card("S",14), pb.Card("H",13)]).getEquity(200000, seed=0, exactThreshold=0, targetError=0.005)
+    if not clearCut.iterations < close.iterations < 200000 or close.standardError > 0.005 or clearCut.iterations != pb.PokerCalculator.firstBatchSize: return False
+    startTime = time.monotonic()
+    result = calc.getEquity(10**9, engine="reference", timeBudget=0.2, batchSize=200)
+    return time.monotonic()-startTime < 1.0 and 0 < result.iterations < 10**9
+
+def testStratifiedSampling():
+    calc = pb.PokerCalculator(1, [pb.Card("S",14), pb.Card("H",13)], [pb.Card("D",2), pb.Card("C",11), pb.Card("D",12)])
+    exact = calc.enumerateEquity().equity
+    if calc._getStrata(10) is not None or len(calc._getStrata(5000)) != 1081 or sum(size for _, size in calc._getStrata(5000)) != 5000: return False
+    engines = ("inplace",) if pb.numpy is None else ("numpy", "inplace")
+    for engine in engines:
+        result = calc.getEquity(20000, engine=engine, seed=3, exactThreshold=0, stratify=True)
+        if result.total != 20000 or abs(result.equity-exact) > 5*result.standardError or result.effectiveSampleSize <= result.total: return False
+        if calc.getEquity(20000, engine=engine, seed=3, exactThreshold=0, stratify=True).equity != result.equity: return False
+    #Merged with a plain result, counting as a single stratum
+    plain = calc.getEquity(20000, engine=engines[0], seed=3, exactThreshold=0)
+    result.add(plain)
+    return result.effectiveSampleSize > result.total and plain.effectiveSampleSize == plain.total and result.standardError < plain.standardError
+
+def testRangeEquities():
+    if pb.numpy is None: return True #Range equities are only available with numpy
+    C = pb.Card
+    rng = random.Random(4)
+    cards = [rng.sample(range(52), 7) for _ in range(500)]
+    ranks = pb.evaluateHandsBatch(pb.numpy.array([hand[:5] for hand in cards]), pb.numpy.array([hand[5:] for hand in cards])[:, None])
+    if ranks[:, 0].tolist() != [pb.evaluate7(hand) for hand in cards]: return False
+    weights = pb.getRangeWeights({"AKs": 1, "QQ": 0.5, ("As", C("H",13)): 2})
+    if weights.count(1.0) != 4 or weights.count(0.5) != 6 or weights.count(2.0) != 1 or pb.getRangeWeights({"AK": 1}).count(1.0) != 16: return False
+    #Shared runouts give each hand's equity against a random opponent
+    table = [C("D",2), C("C",11), C("D",12), C("S",5)]
+    hands = [[C("S",14), C("H",13)], [C("D",14), C("D",13)], [C("D",2), C("H",3)]]
+    equities = pb.getRangeEquities(hands, [None], table, 20000, seed=1)
+    if any(abs(equities[i]-pb.PokerCalculator(1, hands[i], table).enumerateEquity().equity) > 0.015 for i in range(2)) or not math.isnan(equities[2]): return False
+    if pb.getRangeEquities(hands, [None], table, 20000, seed=1).tolist()[:2] != equities.tolist()[:2]: return False
+    #KK against a range of only AA
+    if abs(pb.getRangeEquities([[C("S",13), C("H",13)]], [{"AA": 1}], (), 20000, seed=2)[0]-0.18) > 0.02: return False
+    equities = pb.getRangeEquities(None, [None, None], table[:3], 200, seed=3)
+    return len(equities) == pb.HAND_COUNT and int(pb.numpy.isnan(equities).sum()) == 150
+
+def testEquityCache():
+    C = pb.Card
+    #Canonical states ignore card order and suite names
+    if pb.getCanonicalState(2, [C("S",14), C("S",13)], [C("S",2), C("D",9)]) != pb.getCanonicalState(2, [C("H",13), C("H",14)], [C("C",9), C("H",2)]): return False
+    if pb.getCanonicalState(2, [C("S",14), C("S",13)], []) == pb.getCanonicalState(2, [C("S",14), C("H",13)], []): return False
+    if len({pb.getCanonicalState(1, playerDeck, []) for _, playerDeck in pb.getStartingHandClasses()}) != 169: return False
+    cache = pb.EquityCache(maxSize=2)
+    first = cache.getEquity(pb.PokerCalculator(1, [C("S",14), C("S",13)]), 500, seed=1)
+    if cache.getEquity(pb.PokerCalculator(1, [C("D",13), C("D",14)]), 500, seed=1) is not first or (cache.hits, cache.misses) != (1, 1): return False
+    cache.getEquity(pb.PokerCalculator(1, [C("S",2), C("H",2)]), 500, seed=1)
+    cache.getEquity(pb.PokerCalculator(1, [C("S",3), C("H",3)]), 500, seed=1) #Evicts the least recently used (AKs)
+    if len(cache) != 2 or cache.getEquity(pb.PokerCalculator(1, [C("S",14), C("S",13)]), 500, seed=1) is first: return False
+    #Preflop table answers any settings
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "preflop.json")
+        with open(path, "w") as file:
+            json.dump({"AKs": [[60, 5, 35, 62.5, 61.25]]}, file)
+        cache.loadPreflopTable(path)
+    result = cache.getEquity(pb.PokerCalculator(1, [C("H",13), C("H",14)]), 10**6, targetError=0.001)
+    return result.total == 100 and result.equity == 0.625 and pb.getStartingHandClass([C("H",13), C("D",14)]) == "AKo"
+
+def testInPlaceEngine():
+    calc = pb.PokerCalculator(1, [pb.Card("S",14), pb.Card("H",13)], [pb.Card("D",2), pb.Card("C",11), pb.Card("D",12), pb.Card("H",7)])
+    exact = calc.getEquity()
+    simulated = calc.getEquity(40000, engine="inplace", seed=9, exactThreshold=0)
+    if abs(simulated.equity-exact.equity) > 4*simulated.standardError or simulated.total != 40000: return False
+    buffer = calc._deckBuffer
+    if sorted(buffer) != [card.index for card in calc.deck]: return False #Still a permutation of the remaining cards
+    if calc.getEquity(1000, engine="inplace", seed=9, exactThreshold=0).equity != calc.getEquity(1000, engine="inplace", seed=9, exactThreshold=0).equity: return False
+    calc.updateState(1, [pb.Card("S",3)])
+    calc.getEquity(10, engine="inplace", exactThreshold=0)
+    return calc._deckBuffer is not buffer and len(calc._deckBuffer) == 45
+
+def testEquityExecutor():
+    C = pb.Card
+    cache = pb.EquityCache()
+    executor = pb.EquityExecutor(cache, workers=1)
+    try:
+        results = []
+        done = threading.Event()
+        def callback(ticket, result):
+            results.append(result)
+            if len(results) == 2: done.set()
+        #Identical (suite-isomorphic) questions share one job
+        first = executor.submit(pb.PokerCalculator(2, [C("S",14), C("S",13)]), 5000, callback, engine="inplace", seed=1, exactThreshold=0, timeBudget=5)
+        second = executor.submit(pb.PokerCalculator(2, [C("H",13), C("H",14)]), 5000, callback, engine="inplace", seed=1, exactThreshold=0, timeBudget=5)
+        if first.job is not second.job or not done.wait(10) or results[0] is not results[1] or results[0].total != 5000: return False
+        #Answered from the cache once done
+        if executor.submit(pb.PokerCalculator(2, [C("D",13), C("D",14)]), 5000, callback, engine="inplace", seed=1, exactThreshold=0, timeBudget=5).result is not results[0]: return False
+        #Cancelling every ticket of a job stops it between batches, without calling back or caching
+        startTime = time.monotonic()
+        blocker = executor.submit(pb.PokerCalculator(1, [C("S",2), C("S",3)]), 10**9, callback, engine="inplace", exactThreshold=0, timeBudget=5, batchSize=500)
+        tickets = [executor.submit(pb.PokerCalculator(3, [C("S",2), C("S",3)]), 10**9, callback, engine="inplace", exactThreshold=0, timeBudget=5, batchSize=500) for _ in range(2)]
+        while not blocker.job.future.running(): time.sleep(0.01)
+        for ticket in [blocker]+tickets: ticket.cancel()
+        concurrent.futures.wait([blocker.job.future], 10)
+        return tickets[0].job.future.cancelled() and not executor.jobs and len(results) == 2 and len(cache) == 1 and time.monotonic()-startTime < 4
+    finally:
+        executor.shutdown()
+
+def testSessionRegistry():
+    expired = []
+    registry = pb.SessionRegistry(ttl=60, maxSessions=2, onExpire=expired.append)
+    parent = types.SimpleNamespace(sessions=registry)
+    sessions = [pb.Session(i, types.SimpleNamespace(), parent) for i in range(3)]
+    registry.add(sessions[0])
+    registry.add(sessions[1])
+    if registry.get("0") is not sessions[0] or registry.get("5") is not None: return False
+    registry.add(sessions[2]) #Too many sessions: the least recently active one (1) is removed
+    if registry.evictExtraSessions() != [sessions[1]] or expired != [sessions[1]] or len(registry) != 2 or sessions[1] in registry: return False
+    sessions[0].lastActivity -= 100
+    if registry.expireSessions() != [sessions[0]] or expired != [sessions[1], sessions[0]]: return False
+    if not 0 < registry.getMemoryUsage() < 100000: return False
+    message = pb.StoredMessage(1, 2, 3) #Attributes in __slots__ are counted too
+    if pb._getObjectSize(message, set()) < sys.getsizeof(message)+sys.getsizeof(message.chat)+sys.getsizeof(message.from_user): return False
+    registry.remove(sessions[2])
+    return len(registry) == 0 and registry.expireSessions(time.monotonic()+1000) == []
+
+def testSessionStore():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sessions.db")
+        session, parent = makeSession()
+        expired = []
+        parent.sessions = pb.SessionRegistry(ttl=60, maxSessions=1, onExpire=expired.append, store=pb.SessionStore(path), restore=lambda record: pb.Session.fromRecord(record, parent), spillAfter=10)
+        parent.sessions.add(session)
+        replayCallbacks(session, ["setPlayerCount-2", "setSuite-S", "setValue-14", "setSuite-H", "setValue-13", "mainMenuOnce-reveal", "setSuite-D"])
+        record = session.toRecord()
+        #Idle sessions are spilled to the store, then loaded back by their next callback
+        session.lastActivity -= 20
+        if parent.sessions.expireSessions() != [] or session in parent.sessions or parent.sessions.getStoredCount() != 1: return False
+        restored = parent.sessions.get("0")
+        if restored is session or restored.toRecord() != record or parent.sessions.getStoredCount() != 0: return False
+        shown = replayCallbacks(restored, ["setValue-2"])
+        if restored.calculator.tableCards != [pb.Card("D",2)] or not shown[0].startswith("Number of opponents: 2"): return False
+        #Sessions beyond maxSessions are spilled rather than expired, and everything is spilled before a restart
+        other = pb.Session(1, types.SimpleNamespace(from_user=types.SimpleNamespace(id=2), chat=types.SimpleNamespace(id=2), message_id=1), parent)
+        parent.sessions.add(other)
+        if parent.sessions.evictExtraSessions() != [] or expired or len(parent.sessions) != 1 or parent.sessions.getStoredCount() != 1: return False
+        record = restored.toRecord()
+        parent.sessions.spillAll()
+        parent.sessions.store.close()
+        store = pb.SessionStore(path)
+        parent.sessions = pb.SessionRegistry(ttl=60, store=store, restore=lambda record: pb.Session.fromRecord(record, parent))
+        if len(parent.sessions) != 0 or store.getMaxId() != 1 or parent.sessions.get("0").toRecord() != record: return False
+        #Stored sessions expire after ttl like the others
+        parent.sessions.spillAll()
+        expired = parent.sessions.expireSessions(time.monotonic()+100)
+        storedCount = parent.sessions.getStoredCount()
+        store.close()
+        return sorted(session.id for session in expired) == [0, 1] and storedCount == 0
+
+def testCallbackDispatcher():
+    errors = []
+    dispatcher = pb.CallbackDispatcher(workers=4, errorHandler=errors.append)
+    order = {key: [] for key in range(3)}
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+    def task(key, i):
+        with lock:
+            if key in running: overlaps.append(key) #Two tasks of the same key at once
+            running.add(key)
+        time.sleep(0.001)
+        with lock:
+            running.discard(key)
+        order[key].append(i)
+        if i == 5: raise ValueError("task failed")
+    for i in range(20):
+        for key in range(3):
+            dispatcher.dispatch(key, task, key, i)
+    dispatcher.shutdown()
+    if overlaps or any(order[key] != list(range(20)) for key in range(3)): return False
+    if len(errors) != 3 or dispatcher.pendingCount != 0 or dispatcher.queues: return False
+    #Session IDs handed out from several threads at once are unique
+    parent = types.SimpleNamespace(sessionIds=itertools.count(1), sessionIdLock=threading.Lock())
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        ids = list(pool.map(lambda _: pb.PokerBot.nextSessionId(parent), range(1000)))
+    return sorted(ids) == list(range(1, 1001))
+
+class FakeBot():
+    """Stands in for telebot.TeleBot in session tests: records the messages the bot would send instead of calling Telegram."""
+    def __init__(self):
+        self.log = [] #(method name, text) for each call
+        self.lastMarkup = None #reply_markup of the last message sent or edited
+    
+    def reply_to(self, message, text, reply_markup=None):
+        self.log.append(("reply_to", text))
+        self.lastMarkup = reply_markup
+        return types.SimpleNamespace(chat=types.SimpleNamespace(id=1), id=len(self.log))
+    
+    def send_message(self, chatId, text, reply_markup=None):
+        self.log.append(("send_message", text))
+    
+    def edit_message_text(self, text, reply_markup=None, chat_id=None, message_id=None):
+        self.log.append(("edit_message_text", text))
+        self.lastMarkup = reply_markup
+    
+    def delete_message(self, chat_id=None, message_id=None):
+        self.log.append(("delete_message", None))
+
+class FakeEquityExecutor():
+    """Stands in for pb.EquityExecutor in session tests: calculates winning chances right away, with few iterations."""
+    def submit(self, calculator, iterationCount, callback, **settings):
+        ticket = pb.EquityTicket(self, callback)
+        ticket.result = calculator.getEquity(200, seed=0, exactThreshold=0)
+        return ticket
+    
+    def cancel(self, ticket):
+        ticket.cancelled = True
+
+def makeSession(userId:int=1):
+    """Returns a started session of a fake bot (see FakeBot), and its parent."""
+    parent = types.SimpleNamespace(bot=FakeBot(), equityExecutor=FakeEquityExecutor())
+    parent.sessions = pb.SessionRegistry(ttl=60, maxSessions=10, onExpire=lambda session: None)
+    session = pb.Session(0, types.SimpleNamespace(from_user=types.SimpleNamespace(id=userId), chat=types.SimpleNamespace(id=1), message_id=1), parent)
+    parent.sessions.add(session)
+    session.start()
+    return session, parent
+
+def replayCallbacks(session, script, userId:int=1)->list:
+    """Sends each callback data of script (e.g. "setSuite-S") to session as if userId clicked the buttons. Returns the last text the bot showed after each one."""
+    call = types.SimpleNamespace(from_user=types.SimpleNamespace(id=userId))
+    shown = []
+    for inputData in script:
+        session.callbackHandler(call, inputData)
+        shown.append(session.parent.bot.log[-1][1])
+    return shown
+
+def testSessionFlow():
+    session, parent = makeSession()
+    hand = ["setPlayerCount-2", "setSuite-S", "setValue-14", "setSuite-H", "setValue-14"]
+    shown = replayCallbacks(session, hand)
+    if shown[:4] != ["Select card suite", "Select card value", "Select card suite", "Select card value"]: return False
+    if session.playerCount != 2 or session.playerDeck != [pb.Card("S",14), pb.Card("H",14)] or not shown[4].startswith("Number of opponents: 2"): return False
+    #Reveal the 5 table cards, the main menu is shown after each one
+    for value in range(2, 7):
+        shown = replayCallbacks(session, ["mainMenuOnce-reveal", "setSuite-D", "setValue-"+str(value)])
+        if shown[:2] != ["Select card suite", "Select card value"] or "Cards on table" not in shown[2]: return False
+    if len(session.tableCards) != 5 or session.calculator.tableCards != session.tableCards or session.fullDeckMask.bit_count() != 45: return False
+    if session.actionStack != ["mainMenuLoop", "mainMenuOnce"]: return False
+    #Stale buttons show the expected menu again without changing the game state
+    replayCallbacks(session, ["setValue-3"])
+    if session.actionStack != ["mainMenuLoop", "mainMenuOnce"] or len(session.tableCards) != 5: return False
+    #Replaying keeps thrown away cards, many games in a row don't grow the stack
+    for game in range(3):
+        replayCallbacks(session, ["mainMenuOnce-replay", "setSuite-C", "setValue-"+str(2+2*game), "setSuite-C", "setValue-"+str(3+2*game)])
+        if session.tableCards != [] or session.playerDeck != [pb.Card("C",2+2*game), pb.Card("C",3+2*game)] or len(session.actionStack) != 2: return False
+    if session.fullDeckMask.bit_count() != 39: return False
+    #Only the session creator can use it
+    try:
+        replayCallbacks(session, ["mainMenuOnce-quit"], userId=2)
+        return False
+    except pb.PokerBotException:
+        pass
+    replayCallbacks(session, ["mainMenuOnce-retry"])
+    if session.playerCount is not None or session.fullDeckMask != pb.FULL_DECK_MASK or session.actionStack[-1] != "setPlayerCount": return False
+    replayCallbacks(session, hand+["mainMenuOnce-quit"])
+    return session.actionStack == [] and len(parent.sessions) == 0 and parent.bot.log[-2] == ("reply_to", "Session ended successfully!")
+
+def waitUntilIdle(dispatcher, timeout:float=5)->None:
+    """Waits until dispatcher has no task left."""
+    deadline = time.monotonic()+timeout
+    while dispatcher.pendingCount and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def testWebhookServer():
+    pokerBot = pb.PokerBot("123:TEST", computeWorkers=1, handlerWorkers=2)
+    fake = FakeBot()
+    for name in ("reply_to", "send_message", "edit_message_text", "delete_message"): #Keep telebot's update handling, without calling Telegram
+        setattr(pokerBot.bot, name, getattr(fake, name))
+    for name in ("remove_webhook", "set_webhook"):
+        setattr(pokerBot.bot, name, lambda **settings: None)
+    pokerBot.expireSessionsLoop = lambda: None #No background thread left sleeping after the test
+    thread = threading.Thread(target=pokerBot.start, args=("https://example.org/hook?key=1", "127.0.0.1", 0, "secret"), daemon=True) #Served on the webhook URL's path
+    thread.start()
+    for _ in range(500):
+        if pokerBot.webhookServer is not None: break
+        time.sleep(0.01)
+    server = pokerBot.webhookServer
+    server.ready.wait(5)
+    user = {"id": 7, "is_bot": False, "first_name": "Test"}
+    startUpdate = {"update_id": 1, "message": {"message_id": 10, "date": 0, "chat": {"id": 7, "type": "private"}, "from": user, "text": "/start"}}
+    def post(update, secretToken="secret", path="/hook?key=1")->int:
+        connection = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+        connection.request("POST", path, json.dumps(update) if isinstance(update, dict) else update, {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secretToken})
+        status = connection.getresponse().status
+        connection.close()
+        return status
+    try:
+        if post(startUpdate, secretToken="wrong") != 403 or post(startUpdate, secretToken="s\xe9cret") != 403 or post(startUpdate, path="/other") != 404: return False
+        if post(startUpdate) != 200: return False
+        waitUntilIdle(pokerBot.dispatcher)
+        session = pokerBot.sessions.get("1")
+        if session is None or fake.log != [("reply_to", "Before inputting your cards, how many other players are there?")]: return False
+        callbackUpdate = {"update_id": 2, "callback_query": {"id": "1", "from": user, "chat_instance": "1", "data": "1-setPlayerCount-3"}}
+        if post(callbackUpdate) != 200: return False
+        waitUntilIdle(pokerBot.dispatcher)
+        if session.playerCount != 3 or fake.log[-1] != ("edit_message_text", "Select card suite"): return False
+        malformedUpdate = {"update_id": 3, "callback_query": {"id": "2", "from": user, "chat_instance": "1", "data": "garbage"}}
+        if post(malformedUpdate) != 200: return False #Logged, not failing the request
+        pokerBot.dispatcher.maxPending = 0 #Full dispatcher: updates are refused until it has room again
+        if post(callbackUpdate) != 503 or session.playerCount != 3: return False
+        pokerBot.dispatcher.maxPending = 1000
+        #A new session beyond maxSessions expires the oldest one, calling Telegram from the handler threads rather than the intake thread
+        pokerBot.sessions.maxSessions = 1
+        editThreads = []
+        pokerBot.bot.edit_message_text = lambda *arguments, **settings: (editThreads.append(threading.current_thread().name), fake.edit_message_text(*arguments, **settings))
+        secondStartUpdate = {"update_id": 4, "message": {"message_id": 11, "date": 0, "chat": {"id": 7, "type": "private"}, "from": user, "text": "/start"}}
+        if post(secondStartUpdate) != 200: return False
+        waitUntilIdle(pokerBot.dispatcher)
+        if session in pokerBot.sessions or ("edit_message_text", "This session has expired, use /start to start a new one!") not in fake.log: return False
+        if not editThreads or not all(name.startswith("dispatch") for name in editThreads): return False
+        return post("not json") == 400
+    finally:
+        server.stop()
+        thread.join(5)
+        pokerBot.dispatcher.shutdown()
+        pokerBot.equityExecutor.shutdown()
+
+def testTelegramLogHandler():
+    fake = FakeBot()
+    handler = pb.TelegramLogHandler(fake, 1, minInterval=0.3, batchDelay=0.1, maxQueued=100)
+    logger = pb.logging.getLogger("pokerbot.test")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for _ in range(37):
+            logger.error("Got exception while handling callback: ValueError()")
+        logger.error("Pokerbot has started!")
+        logger.error("Not for the chat", extra={"sendToChat": False})
+        time.sleep(0.2)
+        logger.error("Second batch") #Rate limited: waits until minInterval after the first post
+        if fake.log and fake.log[-1][1].startswith("Second"): return False
+        time.sleep(0.4)
+        if len(fake.log) != 2: return False
+        first, second = fake.log[0][1].split("\n"), fake.log[1][1]
+        if len(first) != 2 or "×37 in the last" not in first[0] or not first[1].endswith("] Pokerbot has started!") or not second.endswith("] Second batch"): return False
+        #Logging never waits for Telegram, even when posts are slow: messages are dropped once the queue is full
+        fake.send_message = lambda chatId, text: (time.sleep(0.5), fake.log.append(("send_message", text)))
+        logger.error("Slow post")
+        time.sleep(0.2) #The sender thread is now waiting for Telegram
+        startTime = time.perf_counter()
+        for i in range(1000):
+            logger.error("Message {}".format(i))
+        if time.perf_counter()-startTime > 0.5 or handler.droppedCount == 0: return False
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    if "more message(s) dropped" not in fake.log[-1][1]: return False
+    #A bot used as a library, without logging configured, still shows INFO messages
+    code = "import pokerbot; pokerbot.PokerBot('123:TEST', computeWorkers=1, handlerWorkers=1).logMessage('Pokerbot has started!')"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return "Pokerbot has started!" in output.stderr
+
+def testMetrics():
+    metrics = pb.metrics
+    metrics.reset()
+    try:
+        session, parent = makeSession()
+        replayCallbacks(session, ["setPlayerCount-1", "setSuite-S", "setValue-14", "setSuite-H", "setValue-14"])
+        snapshot = metrics.getSnapshot()
+        if snapshot[("pokerbot_callback_seconds", "setSuite")].count != 2 or snapshot[("pokerbot_callback_seconds", "setPlayerCount")].count != 1: return False
+        equity = snapshot[("pokerbot_equity_seconds", None)] #Main menu shown once
+        if equity.count != 1 or snapshot[("pokerbot_equity_iterations_total", None)] != 200 or snapshot[("pokerbot_hand_evaluations_total", None)] != 400: return False
+        pb.PokerCalculator.getScore(None, [pb.Card("S", value) for value in range(2, 7)])
+        text = metrics.formatPrometheus()
+        for line in ['pokerbot_callback_seconds_count{action="setValue"} 2', 'pokerbot_callback_seconds_bucket{action="setValue",le="+Inf"} 2', "pokerbot_get_score_calls_total 1", "# TYPE pokerbot_active_sessions gauge"]:
+            if line not in text.split("\n"): return False
+        #Unknown callback actions share one series, label values are escaped
+        replayCallbacks(session, ["bogus\"action-1"])
+        if ("pokerbot_callback_seconds", "other") not in metrics.getSnapshot() or ("pokerbot_callback_seconds", "bogus\"action") in metrics.getSnapshot(): return False
+        metrics.observe("pokerbot_callback_seconds", 0.1, 'a"b\\c\nd')
+        if 'pokerbot_callback_seconds_count{action="a\\"b\\\\c\\nd"} 1' not in metrics.formatPrometheus().split("\n"): return False
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.prom")
+            metrics.writePrometheusFile(path)
+            with open(path) as file:
+                if file.read() != metrics.formatPrometheus(): return False
+        #Only admins can see stats, and turn metrics off at runtime
+        admin = types.SimpleNamespace(adminIds={1}, bot=FakeBot())
+        pb.PokerBot.statsCommand(admin, types.SimpleNamespace(from_user=types.SimpleNamespace(id=2), text="/stats off"))
+        if not metrics.enabled or "not allowed" not in admin.bot.log[-1][1]: return False
+        pb.PokerBot.statsCommand(admin, types.SimpleNamespace(from_user=types.SimpleNamespace(id=1), text="/stats off"))
+        if metrics.enabled or not admin.bot.log[-1][1].startswith("Metrics are off"): return False
+        replayCallbacks(session, ["mainMenuOnce-reveal"])
+        if ("pokerbot_callback_seconds", "mainMenuOnce") in metrics.getSnapshot(): return False #Not recorded while metrics are off
+        pb.PokerBot.statsCommand(admin, types.SimpleNamespace(from_user=types.SimpleNamespace(id=1), text="/stats on"))
+        return metrics.enabled and "setSuite: 2 calls" in admin.bot.log[-1][1]
+    finally:
+        metrics.enabled = True
+        metrics.reset()
+
+def testKeyboardCache():
+    keyboards = pb.KeyboardCache(maxSize=2)
+    markup = json.loads(keyboards.get("12", pb.buildValueKeyboard, 0b1000000000101))
+    if [[(button["text"], button["callback_data"]) for button in row] for row in markup["inline_keyboard"]] != [[("2", "12-setValue-2")], [("4", "12-setValue-4")], [("A", "12-setValue-14")]]: return False
+    if json.loads(keyboards.get("7", pb.buildValueKeyboard, 0b1000000000101))["inline_keyboard"][2][0]["callback_data"] != "7-setValue-14" or len(keyboards.templates) != 1: return False
+    #Cached keyboards are the ones built for the session directly
+    built = pb.buildMainMenuKeyboard(True, False).to_json().replace(pb.KEYBOARD_SESSION_PLACEHOLDER, "3")
+    if keyboards.get("3", pb.buildMainMenuKeyboard, True, False) != built: return False
+    keyboards.get("3", pb.buildSuiteKeyboard, (True, False, True, True)) #Full cache: the least recently used keyboard is dropped
+    if len(keyboards.templates) != 2 or (pb.buildValueKeyboard, 0b1000000000101) in keyboards.templates: return False
+    #Sessions only offer cards still in the deck
+    session, parent = makeSession()
+    replayCallbacks(session, ["setPlayerCount-1", "setSuite-S", "setValue-14", "setSuite-S"])
+    values = [row[0]["text"] for row in json.loads(parent.bot.lastMarkup)["inline_keyboard"]]
+    if values != ["2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K"]: return False
+    replayCallbacks(session, ["setValue-13"])
+    buttons = [row[0]["callback_data"] for row in json.loads(parent.bot.lastMarkup)["inline_keyboard"]]
+    return buttons == ["0-mainMenuOnce-reveal", "0-mainMenuOnce-retry", "0-mainMenuOnce-replay", "0-mainMenuOnce-quit"]
+
+def testBatchEquity():
+    states = [{"hand": ["As", "Ah"], "opponents": 1, "id": "aces"}, {"hand": ["S14", "H13"], "board": ["2d", "Jc", "Qd", "Tc", "3h"], "opponents": 2},
+              {"hand": ["7c", "2d"], "board": ["Ah", "Kh", "Qh"], "opponents": 3, "exact": False, "iterations": 500}, {"hand": ["As"], "opponents": 1}]
+    lines = "\n".join(json.dumps(state) for state in states*5)+"\nnot json\n"
+    outputs = {}
+    for workers in (1, 2):
+        output = io.StringIO()
+        if pb.runBatchEquity(io.StringIO(lines), output, workers=workers, iterationCount=1000, seed=7, chunkSize=3, progressFile=None) != 21: return False
+        outputs[workers] = output.getvalue()
+    if outputs[1] != outputs[2]: return False #Same results and order whatever the worker count
+    results = [json.loads(line) for line in outputs[1].splitlines()]
+    if [result["line"] for result in results] != list(range(1, 22)) or results[0]["id"] != "aces" or results[0]["total"] != 1000: return False
+    if not results[1]["exact"] or results[1] != dict(results[5], line=2) or results[2]["total"] != 500 or results[2]["exact"]: return False
+    if "error" not in results[3] or "error" not in results[20]: return False
+    return pb.Card.fromString("10h") is pb.Card("H", 10) and pb.Card.fromString("S14") is pb.Card("S", 14)
+
+def _getImportedModules(names:tuple)->list:
+    """Process pool task of testImportLight: returns the modules of names the worker process has imported."""
+    return [name for name in names if name in sys.modules]
+
+def testBenchmarkComparison():
+    import pokerbot_bench
+    def report(gamesToTarget, effectiveSamplesPerGame, effectiveSamplesPerSecond)->dict:
+        return {"results": {"benchmarkVarianceReduction": {"flop-stratified": {"gamesToTarget": gamesToTarget, "effectiveSamplesPerGame": effectiveSamplesPerGame, "effectiveSamplesPerSecond": effectiveSamplesPerSecond}}}}
+    baseline = report(8000, 1.3, 800000)
+    if pokerbot_bench.compareResults(baseline, report(6000, 2.0, 1200000)) != []: return False #Improvements only
+    slowdowns = pokerbot_bench.compareResults(baseline, report(12000, 1.0, 500000))
+    return sorted(measure for _, _, measure, _, _ in slowdowns) == ["effectiveSamplesPerGame", "effectiveSamplesPerSecond", "gamesToTarget"]
+
+def testImportLight():
+    #Neither the calculator nor its worker processes import the Telegram bot stack
+    botModules = ("telebot", "requests", "asyncio")
+    code = "import pokerbot, pokerbot_test, sys; print(pokerbot_test._getImportedModules({!r}))".format(botModules)
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if output.stdout.strip() != "[]": return False
+    if pb.getProcessPool(2).submit(_getImportedModules, botModules[:2]).result() != []: return False
+    return pb._importTelebot() is sys.modules["telebot"]
 
 def runAllTests():
-    for func in [testPokerScores, testCardComparison, testCalculatorAssignment]: #TODO: add all functions
+    for func in [testPokerScores, testCardComparison, testCardEncoding, testHandRanks, testSevenCardScores, testCalculatorAssignment, testBatchedEngine, testSeededSimulation, testExactEquity, testAdaptiveSimulation, testStratifiedSampling, testRangeEquities, testEquityCache, testInPlaceEngine, testEquityExecutor, testSessionRegistry, testSessionStore, testCallbackDispatcher, testSessionFlow, testWebhookServer, testTelegramLogHandler, testMetrics, testKeyboardCache, testBatchEquity, testBenchmarkComparison, testImportLight]: #TODO: add all functions
         print(func.__name__, func())
 
 if __name__ == "__main__":